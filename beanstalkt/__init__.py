@@ -1,2 +1,10 @@
 from .beanstalkt import (Client, BeanstalkException, UnexpectedResponse,
         CommandFailed, Buried, DeadlineSoon, TimedOut)
+from .worker import Worker, ReleaseJob, BuryJob, RetryPolicy
+from .envelope import Tracer
+from .histogram import Histogram
+from .recorder import Recorder, Replayer
+from .inspector import Inspector
+from .sync import SyncClient
+from .fair import FairReserver
+from .buffers import BufferPool
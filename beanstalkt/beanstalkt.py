@@ -23,19 +23,25 @@ __version__ = '0.7.0'
 import socket
 import time
 
-from collections import deque
+from collections import deque, OrderedDict
 
+from tornado.concurrent import Future
 from tornado.gen import coroutine, Task, Return, Wait, Callback
 from tornado.ioloop import IOLoop
-from tornado.iostream import IOStream
+from tornado.iostream import IOStream, StreamClosedError
 from tornado import stack_context
 from tornado import version as tornado_version
 from tornado.util import ObjectDict
 
+from .ratelimit import TokenBucket, shared_bucket
+
 
 DEFAULT_PRIORITY = 2 ** 31
 DEFAULT_TTR = 120  # Time (in seconds) To Run a job, min. 1 sec.
 RECONNECT_TIMEOUT = 1  # Time (in seconds) between re-connection attempts
+MAX_BATCH = 65536  # Max. bytes of commands coalesced into a single write
+DEDUP_SIZE = 1024  # Max. number of dedup keys remembered by the client
+DEDUP_TTL = 60  # Time (in seconds) a dedup key is remembered
 
 
 class Bunch:
@@ -62,64 +68,164 @@ class DeadlineSoon(BeanstalkException): pass
 class TimedOut(BeanstalkException): pass
 
 
+class DedupCache(object):
+    """A bounded cache mapping dedup keys to the ids of recently put jobs.
+
+    Keys expire `ttl` seconds after being added. When the cache holds more
+    than `size` keys, the least recently used keys are evicted.
+    """
+    def __init__(self, size=DEDUP_SIZE, ttl=DEDUP_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._cache = OrderedDict()
+
+    def get(self, key):
+        """Returns the job id for the key, or None if not in the cache."""
+        entry = self._cache.pop(key, None)
+        if entry is None or entry[1] < time.time():
+            return None
+        # re-insert as the most recently used key
+        self._cache[key] = entry
+        return entry[0]
+
+    def add(self, key, job_id):
+        """Add the key with the given job id to the cache."""
+        self._cache.pop(key, None)
+        self._cache[key] = (job_id, time.time() + self.ttl)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+
 class Client(object):
 
     def __init__(self, host='localhost', port=11300,
-                 connect_timeout=socket.getdefaulttimeout(), io_loop=None):
+                 connect_timeout=socket.getdefaulttimeout(), io_loop=None,
+                 max_batch=MAX_BATCH, dedup_size=DEDUP_SIZE,
+                 dedup_ttl=DEDUP_TTL, tracer=None, tcp_nodelay=True,
+                 tcp_keepalive=None, sndbuf=None, rcvbuf=None,
+                 max_buffer_size=None, read_chunk_size=None, recorder=None,
+                 buffer_pool=None):
         self._connect_timeout = connect_timeout
         self.host = host
         self.port = port
+        self.tcp_nodelay = tcp_nodelay
+        self.tcp_keepalive = tcp_keepalive
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self._stream_options = dict((k, v) for k, v in [
+                ('max_buffer_size', max_buffer_size),
+                ('read_chunk_size', read_chunk_size)] if v is not None)
         self.io_loop = io_loop or IOLoop.instance()
         self._stream = None
         self._using = 'default'  # current tube
+        self._wire_using = 'default'  # tube used by the requests written
         self._watching = set(['default'])   # set of watched tubes
-        self._queue = deque()
-        self._talking = False
+        self._max_batch = max_batch
+        self._queue = deque()    # requests waiting to be written
+        self._pending = deque()  # requests written, awaiting a response
+        self._flush_scheduled = False
+        self._reading = False
         self._reconnect_cb = None
+        self._dedup = DedupCache(dedup_size, dedup_ttl)
+        self._dedup_puts = {}  # dedup key -> futures waiting for the put
+        self._limits = {}  # (command, tube) -> token bucket
+        self._reserve_debt = None  # future taking the token for a reserve
+        self.tracer = tracer
+        self.recorder = recorder
+        self.buffer_pool = buffer_pool
+        self._buffers = {}  # id of reserved job -> buffer of the pool
+        self.metrics = ObjectDict(commands=0, writes=0, writes_saved=0,
+                dedup_hits=0, dedup_misses=0, dedup_failures=0, bodies=0,
+                body_allocations=0, allocations_per_job=0.0)
 
     def _reconnect(self):
+        # the connection was lost; fail the requests awaiting a response, and
         # wait some time before trying to re-connect
+        self._fail_pending()
         self.io_loop.add_timeout(time.time() + RECONNECT_TIMEOUT,
-                lambda: self.connect(self._reconnected))
+                self._reconnected)
 
+    @coroutine
     def _reconnected(self):
-        # re-establish the used tube and tubes being watched
-        watch = self._watching.difference(['default'])
-        # ignore "default", if it is not in the client's watch list
-        ignore = set(['default']).difference(self._watching)
-
-        def do_next(_=None):
-            try:
-                if watch:
-                    self.watch(watch.pop(), do_next)
-                elif ignore:
-                    self.ignore(ignore.pop(), do_next)
-                elif self._using != 'default':
-                    # change the tube used, and callback to user
-                    self.use(self._using, self._reconnect_cb)
-                elif self._reconnect_cb:
-                    # callback to user
-                    self._reconnect_cb()
-            except:
-                # ignored, as next re-connect will retry the operation
-                pass
-
-        do_next()
+        # if connecting fails, the stream is closed, and the close callback
+        # makes another attempt
+        yield self.connect()
+        if self._reconnect_cb:
+            self._reconnect_cb()
 
     @coroutine
     def connect(self):
         """Connect to beanstalkd server."""
         if not self.closed():
             return
-        self._talking = False
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
-                socket.IPPROTO_TCP)
+        # responses to requests written on a lost connection will never come
+        self._fail_pending()
+        self._reading = False
+        self._wire_using = 'default'
+        # the jobs reserved on a lost connection are released by the server;
+        # their bodies may still be in use, so the buffers are dropped
+        # rather than reused
+        self._buffers.clear()
+        if self.host.startswith('unix:'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.host[5:]
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                    socket.IPPROTO_TCP)
+            self._set_tcp_options(self._socket)
+            address = (self.host, self.port)
+        if self.sndbuf:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                    self.sndbuf)
+        if self.rcvbuf:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    self.rcvbuf)
         if tornado_version >= '5.0':
-            self._stream = IOStream(self._socket)
+            self._stream = IOStream(self._socket, **self._stream_options)
         else:
-            self._stream = IOStream(self._socket, io_loop=self.io_loop)
+            self._stream = IOStream(self._socket, io_loop=self.io_loop,
+                    **self._stream_options)
         self._stream.set_close_callback(self._reconnect)
-        yield Task(self._stream.connect, (self.host, self.port))
+        yield Task(self._stream.connect, address)
+        yield self._restore()
+
+    @coroutine
+    def _restore(self):
+        # re-establish the used tube and the tubes being watched on a new
+        # connection, ahead of the requests queued while connecting
+        queued, self._queue = self._queue, deque()
+        requests = [self.watch(name) for name in sorted(self._watching)
+                if name != 'default']
+        if 'default' not in self._watching:
+            requests.append(self.ignore('default'))
+        if self._using != 'default':
+            requests.append(self.use(self._using))
+        self._queue.extend(queued)
+        self._schedule_flush()
+        yield requests
+
+    def _fail_pending(self):
+        # callback with an error to the requests awaiting a response
+        while self._pending:
+            req, cb = self._pending.popleft()
+            if cb:
+                error = StreamClosedError('connection lost before the '
+                        'response to {!r}'.format(req.cmd))
+                self.io_loop.add_callback(lambda cb=cb, e=error: cb(e))
+
+    def _set_tcp_options(self, sock):
+        if self.tcp_nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.tcp_keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # probe after the idle time, and give up after 3 more intervals
+            # (the options are not available on all platforms)
+            for name, value in [('TCP_KEEPIDLE', self.tcp_keepalive),
+                                ('TCP_KEEPINTVL', self.tcp_keepalive),
+                                ('TCP_KEEPCNT', 3)]:
+                if hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP,
+                            getattr(socket, name), max(int(value), 1))
 
     def set_reconnect_callback(self, callback):
         """Set callback to be called if connection has been lost and
@@ -127,10 +233,70 @@ class Client(object):
 
         If the connection is closed unexpectedly, the client will automatically
         attempt to re-connect with 1 second intervals. After re-connecting, the
-        client will attempt to re-establish the used tube and watched tubes.
+        client re-establishes the used tube and watched tubes, before writing
+        the commands issued while the connection was down. The callback is
+        called when this is done.
         """
         self._reconnect_cb = callback
 
+    def set_rate_limit(self, tube, rate, burst=None, command='put',
+                       shared=False):
+        """Limit the rate (per second) of put or reserve commands for the
+        tube with given name. A rate of None removes the limit.
+
+        The limit is a token bucket holding at most `burst` tokens (default is
+        one second worth of tokens). The command is either 'put', limiting
+        puts into the tube, or 'reserve', limiting the jobs reserved from the
+        tube. The token for a reserved job is taken from the bucket of the
+        tube of the job (looked up with stats-job when several tubes are
+        watched, charging the tightest limit if that fails), and the next
+        reserve waits for it. If shared is True, the
+        limit is shared by all clients in the process setting a shared limit
+        for the same command and tube; the buckets are not thread-safe, so
+        these clients must run on the same IOLoop.
+
+        A command waiting for the limit holds back the commands that must
+        stay in order with it (later puts into the same tube, and the other
+        commands on that tube; later reserves, watches and ignores), without
+        blocking the IOLoop. Other commands, like touching or deleting a
+        reserved job, are written before it.
+        """
+        assert command in ('put', 'reserve')
+        key = (command, tube)
+        if rate is None:
+            self._limits.pop(key, None)
+        elif shared:
+            self._limits[key] = shared_bucket(command, tube, rate, burst)
+        else:
+            self._limits[key] = TokenBucket(rate, burst)
+
+    def _rate_limit(self, command, tube):
+        # take a token from the bucket limiting the command for the tube,
+        # returns a future resolved when the token has been taken, or None
+        bucket = self._limits.get((command, tube))
+        return bucket.acquire(self.io_loop) if bucket else None
+
+    @coroutine
+    def _charge_reserve(self, job_id, watched, debt):
+        # take the token for the reserved job from the bucket limiting
+        # reserves from the tube of the job, after any previous debt
+        if len(watched) == 1:
+            tube = next(iter(watched))
+        else:
+            stats = yield self.stats_job(job_id)
+            if isinstance(stats, Exception):
+                # the tube is unknown, so charge the tightest limit
+                limits = [(self._limits[('reserve', t)].rate, t)
+                        for t in watched if ('reserve', t) in self._limits]
+                tube = min(limits)[1] if limits else None
+            else:
+                tube = stats['tube']
+        if debt:
+            yield debt
+        gate = self._rate_limit('reserve', tube)
+        if gate:
+            yield gate
+
     @coroutine
     def close(self):
         """Close connection to server."""
@@ -147,28 +313,96 @@ class Client(object):
         return not self._stream or self._stream.closed()
 
     def _interact(self, request, callback):
-        # put the interaction request into the FIFO queue
+        # put the interaction request into the FIFO queue, to be written
+        # together with any other requests made in this IOLoop iteration
         cb = stack_context.wrap(callback)
         self._queue.append((request, cb))
-        self._process_queue()
+        if request.gate:
+            # flush again when the rate limit lets the request pass
+            self.io_loop.add_future(request.gate,
+                    lambda _: self._schedule_flush())
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.io_loop.add_callback(self._process_queue)
 
     def _process_queue(self):
-        if self._talking or not self._queue:
+        self._flush_scheduled = False
+        if not self._queue or self.closed():
+            # requests are written when the client has (re-)connected
+            return
+        if self._max_batch <= 0 and self._pending:
+            # no batching: wait for the response to the last request
             return
-        # pop a request of the queue and perform the send-receive interaction
-        self._talking = True
+        # pop requests of the queue, and write them to the socket stream in
+        # a single write of at most max_batch bytes (or one request)
+        chunks = []
+        size = 0
+        held = deque()  # requests held back, kept in the queue
+        blocked = set()  # the order keys of the requests held back
+        full = False
+        while self._queue:
+            req, cb = self._queue[0]
+            if req.order in blocked or (req.gate and not req.gate.done()):
+                # waiting for a rate limit, or for a request it must stay in
+                # order with; the requests after it may pass it
+                blocked.add(req.order)
+                held.append(self._queue.popleft())
+                continue
+            requests = [(req, cb)]
+            if req.tube is not None and req.tube != self._wire_using:
+                # requests for another tube were written before this one
+                use = Bunch(cmd='use {}'.format(req.tube).encode('utf8'),
+                        ok=['USING'], using=req.tube)
+                requests.insert(0, (use, None))
+            commands = [self._command(r) for r, _ in requests]
+            length = sum(len(c) for c in commands)
+            if chunks and size + length > self._max_batch:
+                full = True
+                break
+            self._queue.popleft()
+            for (r, callback), command in zip(requests, commands):
+                self._pending.append((r, callback))
+                if r.using is not None:
+                    self._wire_using = r.using
+                if self.recorder:
+                    self.recorder.request(self, command)
+                self.metrics.commands += 1
+            chunks += commands
+            size += length
+        if held:
+            held.extend(self._queue)
+            self._queue = held
+        if not chunks:
+            return
+        self.metrics.writes += 1
+        self.metrics.writes_saved = self.metrics.commands - self.metrics.writes
         with stack_context.NullContext():
-            req, cb = self._queue.popleft()
-            command = req.cmd + b'\r\n'
-            if req.body:
-                command += req.body + b'\r\n'
-
-            # write command and body to socket stream
-            self._stream.write(command,
-                    # when command is written: read line from socket stream
-                    lambda: self._stream.read_until(b'\r\n',
-                    # when a line has been read: return status and results
-                    lambda data: self._recv(req, data, cb)))
+            self._stream.write(b''.join(chunks))
+        self._read_response()
+        if full and self._max_batch > 0:
+            # max. batch size reached, write the rest in the next iteration
+            self._schedule_flush()
+
+    def _command(self, req):
+        # the bytes of the command line, and body, of the request
+        if req.body is None:
+            return req.cmd + b'\r\n'
+        return b''.join([req.cmd, b'\r\n', req.body, b'\r\n'])
+
+    def _read_response(self):
+        # read the response to the oldest pending request; responses arrive
+        # in the same order as the requests were written
+        if self._reading or not self._pending:
+            return
+        self._reading = True
+        req, cb = self._pending[0]
+        with stack_context.NullContext():
+            # read line from socket stream, and return status and results
+            self._stream.read_until(b'\r\n',
+                    lambda data: self._recv(req, data, cb))
 
     def _recv(self, req, data, cb):
         # parse the data received as server response
@@ -192,9 +426,18 @@ class Client(object):
         else:
             error = UnexpectedResponse(**err_args)
 
+        if req.raw:
+            # a replayed command, the response is returned as is
+            error = None
+            read_body = status in ('RESERVED', 'FOUND', 'OK')
+        else:
+            read_body = req.read_body and not error
+
         resp = Bunch(req=req, status=status, values=values, error=error)
+        if self.recorder:
+            resp.raw = data
 
-        if error or not req.read_body:
+        if not read_body:
             # end the request and callback with results
             self._do_callback(cb, resp)
         else:
@@ -204,10 +447,48 @@ class Client(object):
                 resp.job_id = int(job_id)
             else:
                 size = int(values[0])
-            self._stream.read_bytes(size + 2,
-                    lambda data: self._recv_body(data[:-2], resp, cb))
+            if req.parse_yaml:
+                self._stream.read_bytes(size + 2,
+                        lambda data: self._recv_body(data[:-2], resp, cb))
+            else:
+                self._read_job_body(size, resp, cb)
+
+    def _read_job_body(self, size, resp, cb):
+        # read the body of a job; with a buffer pool, the body of a reserved
+        # job is read into a buffer of the pool (Tornado 5 and later), or at
+        # least the crlf is stripped off without copying the body
+        pool = self.buffer_pool if resp.req.pooled else None
+        if pool and hasattr(self._stream, 'read_into'):
+            allocations = pool.allocations
+            buf = pool.acquire(size + 2)
+            if buf is not None:
+                self._count_body(pool.allocations - allocations)
+                resp.buffer = buf
+                view = memoryview(buf)[:size + 2]
+                self._stream.read_into(view,
+                        callback=lambda n: self._recv_body(view[:size],
+                        resp, cb))
+                return
+        if pool:
+            self._count_body(1)
+            strip = lambda data: memoryview(data)[:size]
+        else:
+            # the data read, and the slice of it
+            self._count_body(2)
+            strip = lambda data: data[:-2]
+        self._stream.read_bytes(size + 2,
+                lambda data: self._recv_body(strip(data), resp, cb))
+
+    def _count_body(self, allocations):
+        metrics = self.metrics
+        metrics.bodies += 1
+        metrics.body_allocations += allocations
+        metrics.allocations_per_job = (float(metrics.body_allocations) /
+                metrics.bodies)
 
     def _recv_body(self, data, resp, cb):
+        if self.recorder:
+            resp.raw += memoryview(data).tobytes() + b'\r\n'
         if resp.req.parse_yaml:
             # parse the yaml encoded body
             self._parse_yaml(data, resp, cb)
@@ -215,6 +496,11 @@ class Client(object):
             # don't parse body, it is a job!
             # end the request and callback with results
             resp.body = ObjectDict(id=resp.job_id, body=data)
+            if resp.buffer is not None:
+                self._buffers[resp.job_id] = resp.buffer
+            if self.tracer and not resp.req.raw:
+                self.tracer.unwrap(resp.body,
+                        reserved=resp.req.cmd.startswith(b'reserve'))
             self._do_callback(cb, resp)
 
     def _parse_yaml(self, data, resp, cb):
@@ -233,10 +519,15 @@ class Client(object):
         self._do_callback(cb, resp)
 
     def _do_callback(self, cb, resp):
-        # end the request and process next item in the queue
-        # and callback with results
-        self._talking = False
-        self.io_loop.add_callback(self._process_queue)
+        # end the request, read the response to the next pending request,
+        # process next item in the queue and callback with results
+        self._pending.popleft()
+        self._reading = False
+        if self.recorder:
+            self.recorder.response(self, resp.raw)
+        self._read_response()
+        if self._queue:
+            self._schedule_flush()
 
         if not cb:
             return
@@ -245,7 +536,11 @@ class Client(object):
         obj = None
         req = resp.req
 
-        if resp.error:
+        if req.raw:
+            # callback with the response (status, values and body)
+            obj = resp
+
+        elif resp.error:
             obj = resp.error
 
         elif req.read_value:
@@ -261,12 +556,21 @@ class Client(object):
 
         self.io_loop.add_callback(lambda: cb(obj))
 
+    @coroutine
+    def _raw_command(self, cmd, body=None):
+        # write the command as is, and return the response (a bunch with the
+        # status, values and any body), for replaying recorded traffic
+        request = Bunch(cmd=cmd, body=body, raw=True)
+        resp = yield Task(self._interact, request)
+        raise Return(resp)
+
     #
     #  Producer commands
     #
 
     @coroutine
-    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=120):
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=120,
+            dedup_key=None, trace_id=None):
         """Put a job body (a byte string) into the current tube.
 
         The job can be delayed a number of seconds, before it is put in the
@@ -275,17 +579,60 @@ class Client(object):
         The job is assigned a Time To Run (ttr, in seconds), the mininum is
         1 sec., default is ttr=120 sec.
 
+        If a dedup_key is given, and a job with the same key was recently put
+        into the current tube by the client, the job is not put again, and the
+        id of the existing job is returned without contacting the server.
+        Concurrent puts with the same key share a single request.
+
+        If the client has a tracer, the body is wrapped in an envelope with
+        the given trace id (a 64-bit integer), or a random one.
+
         Calls back with id when job is inserted. If an error occured,
         the callback gets a Buried or CommandFailed exception. The job is
         buried when either the body is too big, so server ran out of memory,
         or when the server is in draining mode.
         """
+        if dedup_key is not None:
+            key = (self._using, dedup_key)
+            job_id = self._dedup.get(key)
+            while job_id is None and key in self._dedup_puts:
+                # wait for the put already in progress; if it did not
+                # complete, look again
+                future = Future()
+                self._dedup_puts[key].append(future)
+                job_id = yield future
+                if job_id is None:
+                    job_id = self._dedup.get(key)
+            if isinstance(job_id, Exception):
+                self.metrics.dedup_failures += 1
+                raise Return(job_id)
+            elif job_id is not None:
+                self.metrics.dedup_hits += 1
+                raise Return(job_id)
+            self.metrics.dedup_misses += 1
+        assert isinstance(body, bytes)
+        if self.tracer:
+            body = self.tracer.wrap(body, self._using, trace_id)
         cmd = 'put {} {} {} {}'.format(priority, delay, ttr,
             len(body)).encode('utf8')
-        assert isinstance(body, bytes)
         request = Bunch(cmd=cmd, ok=['INSERTED'], err=['BURIED', 'JOB_TOO_BIG',
-                'DRAINING'], body=body, read_value=True)
-        resp = yield Task(self._interact, request)
+                'DRAINING'], body=body, read_value=True, tube=self._using,
+                order=('tube', self._using),
+                gate=self._rate_limit('put', self._using))
+        if dedup_key is None:
+            resp = yield Task(self._interact, request)
+            raise Return(resp)
+        resp = None
+        self._dedup_puts[key] = []
+        try:
+            resp = yield Task(self._interact, request)
+            if not isinstance(resp, Exception):
+                self._dedup.add(key, resp)
+        finally:
+            # the puts waiting get the id, or the error (None, if the put
+            # raised an exception)
+            for future in self._dedup_puts.pop(key):
+                future.set_result(resp)
         raise Return(resp)
 
     @coroutine
@@ -295,11 +642,13 @@ class Client(object):
         Calls back with the name of the tube now being used.
         """
         cmd = 'use {}'.format(name).encode('utf8')
-        request = Bunch(cmd=cmd, ok=['USING'],
-                read_value=True)
+        request = Bunch(cmd=cmd, ok=['USING'], read_value=True, using=name)
+        # the tube is used by subsequent commands, also those written before
+        # the response has been received
+        previous, self._using = self._using, name
         resp = yield Task(self._interact, request)
-        if not isinstance(resp, Exception):
-            self._using = resp
+        if isinstance(resp, Exception) and self._using == name:
+            self._using = previous
         raise Return(resp)
 
     #
@@ -307,10 +656,14 @@ class Client(object):
     #
 
     @coroutine
-    def reserve(self, timeout=None):
+    def reserve(self, timeout=None, tubes=None):
         """Reserve a job from one of the watched tubes, with optional timeout
         in seconds.
 
+        If tubes (a list of names) is given, the client watches exactly these
+        tubes from now on, sending the watch and ignore commands needed
+        before the reserve.
+
         Not specifying a timeout (timeout=None, the default) will make the
         client put the communication with beanstalkd on hold, until either a
         job is reserved, or a already reserved job is approaching it's TTR
@@ -325,14 +678,32 @@ class Client(object):
         Calls back with a job dict (keys id and body). If the request timed out,
         the callback gets a TimedOut exception. If a reserved job has deadline
         within the next second, the callback gets a DeadlineSoon exception.
+
+        With a buffer pool, the body is a memoryview of a buffer, which is
+        reused when the job is deleted, released or buried. Copy the body
+        (with bytes() or tobytes()) to keep it after that.
         """
+        if tubes is not None:
+            tubes = set(tubes)
+            for name in sorted(tubes - self._watching):
+                self.watch(name)
+            for name in sorted(self._watching - tubes):
+                self.ignore(name)
+        watched = frozenset(self._watching)
         if timeout is not None:
             cmd = 'reserve-with-timeout {}'.format(timeout).encode('utf8')
         else:
             cmd = b'reserve'
         request = Bunch(cmd=cmd, ok=['RESERVED'], err=['DEADLINE_SOON',
-                'TIMED_OUT'], read_body=True)
+                'TIMED_OUT'], read_body=True, pooled=True, order='reserve',
+                gate=self._reserve_debt)
+        self._reserve_debt = None
         resp = yield Task(self._interact, request)
+        if not isinstance(resp, Exception) and any(('reserve', tube) in
+                self._limits for tube in watched):
+            # the next reserve waits for the token for this job
+            self._reserve_debt = self._charge_reserve(resp.id, watched,
+                    self._reserve_debt)
         raise Return(resp)
 
     @coroutine
@@ -346,6 +717,7 @@ class Client(object):
         cmd = 'delete {}'.format(job_id).encode('utf8')
         request = Bunch(cmd=cmd, ok=['DELETED'], err=['NOT_FOUND'])
         resp = yield Task(self._interact, request)
+        self._finished(job_id, 'deleted', resp)
         raise Return(resp)
 
     @coroutine
@@ -365,6 +737,7 @@ class Client(object):
         cmd = 'release {} {} {}'.format(job_id, priority, delay).encode('utf8')
         request = Bunch(cmd=cmd, ok=['RELEASED'], err=['BURIED', 'NOT_FOUND'])
         resp = yield Task(self._interact, request)
+        self._finished(job_id, 'released', resp)
         raise Return(resp)
 
     @coroutine
@@ -379,8 +752,17 @@ class Client(object):
         cmd = 'bury {} {}'.format(job_id, priority).encode('utf8')
         request = Bunch(cmd=cmd, ok=['BURIED'], err=['NOT_FOUND'])
         resp = yield Task(self._interact, request)
+        self._finished(job_id, 'buried', resp)
         raise Return(resp)
 
+    def _finished(self, job_id, outcome, resp):
+        # the client is done with a reserved job
+        if self.tracer and not isinstance(resp, CommandFailed):
+            self.tracer.finished(job_id, outcome)
+        buf = self._buffers.pop(job_id, None)
+        if buf is not None:
+            self.buffer_pool.release(buf)
+
     @coroutine
     def touch(self, job_id):
         """Touch job with given id.
@@ -394,6 +776,10 @@ class Client(object):
         cmd = 'touch {}'.format(job_id).encode('utf8')
         request = Bunch(cmd=cmd, ok=['TOUCHED'], err=['NOT_FOUND'])
         resp = yield Task(self._interact, request)
+        if isinstance(resp, CommandFailed):
+            # the job is no longer reserved by the client (its TTR expired,
+            # or it was deleted), so its buffer is dropped
+            self._buffers.pop(job_id, None)
         raise Return(resp)
 
     @coroutine
@@ -403,10 +789,11 @@ class Client(object):
         Calls back with number of tubes currently in the watch list.
         """
         cmd = 'watch {}'.format(name).encode('utf8')
-        request = Bunch(cmd=cmd, ok=['WATCHING'], read_value=True)
-        resp = yield Task(self._interact, request)
+        request = Bunch(cmd=cmd, ok=['WATCHING'], read_value=True,
+                order='reserve')
         # add to the client's watch list
         self._watching.add(name)
+        resp = yield Task(self._interact, request)
         raise Return(resp)
 
     @coroutine
@@ -419,11 +806,10 @@ class Client(object):
         """
         cmd = 'ignore {}'.format(name).encode('utf8')
         request = Bunch(cmd=cmd, ok=['WATCHING'], err=['NOT_IGNORED'],
-                read_value=True)
+                read_value=True, order='reserve')
+        # remove from the client's watch list
+        self._watching.discard(name)
         resp = yield Task(self._interact, request)
-        if name in self._watching:
-            # remove from the client's watch list
-            self._watching.remove(name)
         raise Return(resp)
 
     #
@@ -435,6 +821,10 @@ class Client(object):
         cmd = 'peek{}'.format(variant).encode('utf8')
         request = Bunch(cmd=cmd, ok=['FOUND'], err=['NOT_FOUND'],
                 read_body=True)
+        if variant.startswith('-'):
+            # peek-ready, peek-delayed and peek-buried look in the used tube
+            request.tube = self._using
+            request.order = ('tube', self._using)
         self._interact(request, callback)
 
     @coroutine
@@ -484,7 +874,8 @@ class Client(object):
         Calls back with the number of jobs actually kicked.
         """
         cmd = 'kick {}'.format(bound).encode('utf8')
-        request = Bunch(cmd=cmd, ok=['KICKED'], read_value=True)
+        request = Bunch(cmd=cmd, ok=['KICKED'], read_value=True,
+                tube=self._using, order=('tube', self._using))
         resp = yield Task(self._interact, request)
         raise Return(resp)
 
@@ -547,7 +938,8 @@ class Client(object):
     @coroutine
     def list_tube_used(self):
         """Name of the tube currently being used."""
-        request = Bunch(cmd=b'list-tube-used', ok=['USING'], read_value=True)
+        request = Bunch(cmd=b'list-tube-used', ok=['USING'], read_value=True,
+                tube=self._using)
         resp = yield Task(self._interact, request)
         raise Return(resp)
 
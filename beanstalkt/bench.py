@@ -0,0 +1,357 @@
+"""beanstalkt.bench - Load generator for beanstalkd servers
+
+Producers put jobs into a number of tubes, and consumers reserve and delete
+them, for a given duration. The throughput, put latency, queue wait time and
+end-to-end latency are measured by the client, and the server's stats are
+sampled before and after the run.
+
+The SyncClient benchmark compares threads sharing a SyncClient with threads
+having a blocking connection each.
+"""
+
+import random
+import socket
+import threading
+import time
+
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+
+from .beanstalkt import Client, DEFAULT_PRIORITY, TimedOut
+from .envelope import Tracer
+from .histogram import Histogram
+
+
+def parse_body_size(spec):
+    """Returns a function generating body sizes after the spec, which is
+    either a size in bytes, "uniform:MIN:MAX" or "exp:MEAN".
+    """
+    kind, _, args = spec.partition(':')
+    if not args:
+        size = int(kind)
+        return lambda: size
+    args = [int(a) for a in args.split(':')]
+    if kind == 'uniform':
+        return lambda: random.randint(args[0], args[1])
+    elif kind == 'exp':
+        return lambda: int(random.expovariate(1.0 / args[0]))
+    raise ValueError('invalid body size: {}'.format(spec))
+
+
+class Bench(object):
+    """A benchmark run against the beanstalkd server at host and port.
+
+    The producers and consumers are spread over the given number of
+    connections (default is a connection each). Producer i puts jobs into
+    tube i modulo the number of tubes, keeping up to `in_flight` puts waiting
+    for a reply. The jobs get a random priority in `priority_range`, and the
+    fraction `delayed` of the jobs are delayed `delay` seconds. Consumers
+    watch all the tubes. Options for the clients can be given as a dict in
+    client_options.
+
+    When the duration has passed, the producers stop, and the consumers
+    reserve the jobs left in the tubes, until a reserve times out.
+    """
+
+    def __init__(self, host='localhost', port=11300, producers=1,
+                 consumers=1, connections=None, body_size='100', tubes=1,
+                 priority_range=(DEFAULT_PRIORITY, DEFAULT_PRIORITY),
+                 delayed=0.0, delay=1, duration=10, in_flight=1,
+                 tube_prefix='bench', client_options=None, io_loop=None):
+        self.host = host
+        self.port = port
+        self.producers = producers
+        self.consumers = consumers
+        self.connections = connections or producers + consumers
+        self.body_size = parse_body_size(body_size)
+        self.tubes = ['{}-{}'.format(tube_prefix, i) for i in range(tubes)]
+        self.priority_range = priority_range
+        self.delayed = delayed
+        self.delay = delay
+        self.duration = duration
+        self.in_flight = in_flight
+        self.client_options = client_options or {}
+        self.io_loop = io_loop or IOLoop.instance()
+        self.tracer = Tracer()
+        self.put_latency = Histogram()
+        self.puts = 0
+        self.reserves = 0
+        self.errors = 0
+        self.put_elapsed = 0.0  # from the start to the last put done
+        self.reserve_elapsed = 0.0  # from the start to the last reserve
+        self._body = b''
+        self._stop_at = None
+        self._started = None
+
+    @coroutine
+    def run(self):
+        """Run the benchmark, and return a report (a dict)."""
+        clients = [Client(self.host, self.port, io_loop=self.io_loop,
+                tracer=self.tracer, **self.client_options)
+                for _ in range(self.connections)]
+        yield [c.connect() for c in clients]
+        # consumers may share connections with producers, when there are
+        # fewer connections than producers and consumers
+        consumers = [clients[(self.producers + i) % len(clients)]
+                for i in range(self.consumers)]
+        watching = []
+        for client in consumers:
+            if client not in watching:
+                watching.append(client)
+        yield [self._watch(c) for c in watching]
+        before = yield clients[0].stats()
+
+        started = self._started = time.time()
+        self._stop_at = started + self.duration
+        actors = [self._produce(clients[i % len(clients)], i)
+                for i in range(self.producers)]
+        actors += [self._consume(client) for client in consumers]
+        yield actors
+        elapsed = time.time() - started
+
+        after = yield clients[0].stats()
+        yield [c.close() for c in clients]
+        raise Return(self.report(elapsed, before, after))
+
+    @coroutine
+    def _watch(self, client):
+        yield [client.watch(tube) for tube in self.tubes]
+        if 'default' not in self.tubes:
+            yield client.ignore('default')
+
+    @coroutine
+    def _produce(self, client, index):
+        tube = self.tubes[index % len(self.tubes)]
+        pending = []
+        while time.time() < self._stop_at or pending:
+            while len(pending) < self.in_flight and (
+                    time.time() < self._stop_at):
+                pending.append(self._put(client, tube))
+            yield pending.pop(0)
+        self.put_elapsed = max(self.put_elapsed, time.time() - self._started)
+
+    @coroutine
+    def _put(self, client, tube):
+        size = self.body_size()
+        if len(self._body) < size:
+            self._body = b'x' * size
+        if client._using != tube:
+            client.use(tube)
+        delay = self.delay if random.random() < self.delayed else 0
+        started = time.time()
+        job_id = yield client.put(self._body[:size],
+                priority=random.randint(*self.priority_range), delay=delay)
+        self.put_latency.add(time.time() - started)
+        if isinstance(job_id, Exception):
+            self.errors += 1
+        else:
+            self.puts += 1
+
+    @coroutine
+    def _consume(self, client):
+        job = None
+        while True:
+            if time.time() < self._stop_at:
+                timeout = 1
+            else:
+                # drain the tubes, also waiting for the delayed jobs
+                timeout = self.delay + 1 if self.delayed else 1
+            requests = [client.reserve(timeout)]
+            if job:
+                requests.insert(0, client.delete(job.id))
+            results = yield requests
+            job = results[-1]
+            if isinstance(job, Exception):
+                if not isinstance(job, TimedOut):
+                    self.errors += 1
+                elif time.time() >= self._stop_at:
+                    break
+                job = None
+            else:
+                self.reserves += 1
+                # the rate excludes the final wait for more jobs
+                self.reserve_elapsed = time.time() - self._started
+            if isinstance(results[0], Exception) and len(results) == 2:
+                self.errors += 1
+
+    def report(self, elapsed, before, after):
+        """The report of the benchmark (a dict). The put rate is taken over
+        the time until the last put was done, and the reserve rate over the
+        time until the last job was reserved, which excludes the time the
+        consumers waited for more jobs at the end.
+        """
+        queue_wait = Histogram()
+        latency = Histogram()
+        for tube in self.tubes:
+            if tube in self.tracer.queue_wait:
+                queue_wait.merge(self.tracer.queue_wait[tube])
+            if tube in self.tracer.latency:
+                latency.merge(self.tracer.latency[tube])
+        server = {}
+        if not isinstance(before, Exception) and not isinstance(after,
+                Exception):
+            server = dict((k, after[k] - v) for k, v in before.items()
+                    if isinstance(v, (int, float)) and k in after)
+        rate = lambda count, seconds: count / seconds if seconds else 0.0
+        return dict(elapsed=elapsed, puts=self.puts,
+                reserves=self.reserves, errors=self.errors,
+                put_elapsed=self.put_elapsed,
+                reserve_elapsed=self.reserve_elapsed,
+                put_rate=rate(self.puts, self.put_elapsed),
+                reserve_rate=rate(self.reserves, self.reserve_elapsed),
+                put_latency=self.put_latency.summary(),
+                queue_wait=queue_wait.summary(),
+                end_to_end=latency.summary(),
+                server=server)
+
+
+class BlockingConnection(object):
+    """A minimal blocking connection, with the commands used by the
+    SyncClient benchmark, as a thread would have without a SyncClient.
+    """
+
+    def __init__(self, host, port):
+        if host.startswith('unix:'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(host[5:])
+        else:
+            self._socket = socket.create_connection((host, port))
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                    1)
+        self._file = self._socket.makefile('rb')
+
+    def _command(self, line, body=None):
+        data = line.encode('utf8') + b'\r\n'
+        if body is not None:
+            data += body + b'\r\n'
+        self._socket.sendall(data)
+        return self._file.readline().split()
+
+    def use(self, tube):
+        self._command('use {}'.format(tube))
+
+    def watch(self, tube):
+        self._command('watch {}'.format(tube))
+
+    def put(self, body):
+        reply = self._command('put {} 0 {} {}'.format(DEFAULT_PRIORITY,
+                120, len(body)), body)
+        return int(reply[1])
+
+    def reserve(self, timeout):
+        reply = self._command('reserve-with-timeout {}'.format(timeout))
+        if reply[0] != b'RESERVED':
+            return None
+        body = self._file.read(int(reply[2]) + 2)[:-2]
+        return int(reply[1]), body
+
+    def delete(self, job_id):
+        self._command('delete {}'.format(job_id))
+
+    def close(self):
+        self._socket.sendall(b'quit\r\n')
+        self._file.close()
+        self._socket.close()
+
+
+def sync_bench(host='localhost', port=11300, threads=16, connections=2,
+               body_size='100', duration=10, tube='bench-sync'):
+    """Compare threads sharing a SyncClient with `connections` connections,
+    with threads having a blocking connection each. Each thread puts a job,
+    reserves a job and deletes it, in a loop for the duration. Returns a
+    report (a dict) for each of the two setups.
+    """
+    from .sync import SyncClient
+
+    sizes = parse_body_size(body_size)
+
+    def loop(put, reserve, delete, latency, counts):
+        stop_at = time.time() + duration
+        body = b''
+        while time.time() < stop_at:
+            size = sizes()
+            if len(body) < size:
+                body = b'x' * size
+            started = time.time()
+            put(body[:size])
+            job = reserve()
+            if job is not None:
+                delete(job)
+            latency.add(time.time() - started)
+            counts[0] += 1
+
+    def run(setup):
+        latency = [Histogram() for _ in range(threads)]
+        counts = [[0] for _ in range(threads)]
+        workers = [threading.Thread(target=setup, args=(latency[i],
+                counts[i])) for i in range(threads)]
+        started = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.time() - started
+        for h in latency[1:]:
+            latency[0].merge(h)
+        loops = sum(c[0] for c in counts)
+        return dict(elapsed=elapsed, loops=loops, rate=loops / elapsed,
+                latency=latency[0].summary())
+
+    client = SyncClient(host, port, connections=connections)
+    def shared(latency, counts):
+        def reserve():
+            job = client.reserve(1, tubes=[tube])
+            return None if isinstance(job, Exception) else job.id
+        loop(lambda body: client.put(body, tube=tube), reserve,
+                client.delete, latency, counts)
+    try:
+        report = dict(shared=run(shared))
+    finally:
+        client.close()
+
+    def per_thread(latency, counts):
+        conn = BlockingConnection(host, port)
+        conn.use(tube)
+        conn.watch(tube)
+        def reserve():
+            job = conn.reserve(1)
+            return job and job[0]
+        try:
+            loop(conn.put, reserve, conn.delete, latency, counts)
+        finally:
+            conn.close()
+    report['per_thread'] = run(per_thread)
+    report.update(threads=threads, connections=connections)
+    return report
+
+
+def format_sync_report(report):
+    """Format the report of the SyncClient benchmark as text."""
+    lines = []
+    for name, title in [('shared', 'shared SyncClient, {connections} '
+            'connections'), ('per_thread', 'a connection per thread')]:
+        r = report[name]
+        lines.append(('{threads} threads, ' + title).format(**report))
+        lines.append('  {:.0f} put/reserve/delete loops/s, latency ms: p50 '
+                '{:.2f}, p99 {:.2f}, max {:.2f}'.format(r['rate'],
+                *[r['latency'][k] * 1000 for k in ('p50', 'p99', 'max')]))
+    return '\n'.join(lines)
+
+
+def format_report(report):
+    """Format the report as text."""
+    lines = ['{elapsed:.1f}s, {puts} puts in {put_elapsed:.1f}s '
+            '({put_rate:.0f}/s), {reserves} reserves in '
+            '{reserve_elapsed:.1f}s ({reserve_rate:.0f}/s), '
+            '{errors} errors'.format(**report)]
+    for name in ['put_latency', 'queue_wait', 'end_to_end']:
+        summary = report[name]
+        if summary['count']:
+            lines.append('{:<12} ms: mean {:.2f}, p50 {:.2f}, p90 {:.2f}, '
+                    'p99 {:.2f}, max {:.2f}'.format(name, *[summary[k] * 1000
+                    for k in ('mean', 'p50', 'p90', 'p99', 'max')]))
+    if report['server']:
+        lines.append('server stats deltas:')
+        lines += ['  {}: {:g}'.format(k, v)
+                for k, v in sorted(report['server'].items()) if v]
+    return '\n'.join(lines)
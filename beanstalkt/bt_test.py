@@ -3,8 +3,18 @@
 Requires a running instance of beanstalkd.
 """
 
+import io
+import os
+import socket
+import tempfile
+import time
 import uuid
 
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
 from tornado.testing import main, AsyncTestCase, gen_test
 
 import beanstalkt
@@ -124,9 +134,702 @@ class BeanstalkTest(AsyncTestCase):
         check(job1, job1_id)
         yield self.btc.delete(job1_id)
 
+    @gen_test
+    def test_write_coalescing(self):
+        """Test that commands issued in the same iteration share a write"""
+        key = uuid.uuid4().hex
+        yield self.btc.use(key)
+        writes = self.btc.metrics.writes
+        job_ids = yield [self.btc.put(b'test job') for _ in range(10)]
+        self.assertEqual(self.btc.metrics.writes, writes + 1)
+        self.assertGreaterEqual(self.btc.metrics.writes_saved, 9)
+        self.assertEqual(job_ids, sorted(job_ids))
+        yield [self.btc.delete(job_id) for job_id in job_ids]
+
+    @gen_test
+    def test_connection_lost(self):
+        """Test that requests awaiting a response fail when re-connecting"""
+        key = uuid.uuid4().hex
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        yield [client.use(key), client.watch(key), client.ignore('default')]
+        # the put is written behind a reserve waiting for a job
+        reserve = client.reserve()
+        put = client.put(b'job')
+        yield gen.moment
+        client._stream.close()
+        yield client.connect()
+        results = yield [reserve, put]
+        for result in results:
+            self.assertIsInstance(result, StreamClosedError)
+        self.assertEqual(len(client._pending), 0)
+
+        # the puts waiting for a failed put with the same dedup key fail too,
+        # and the key can be used again
+        yield [client.use(key), client.watch(key), client.ignore('default')]
+        client.reserve()
+        puts = [client.put(b'job', dedup_key='a') for _ in range(2)]
+        yield gen.moment
+        client._stream.close()
+        yield client.connect()
+        yield client.use(key)
+        results = yield puts
+        for result in results:
+            self.assertIsInstance(result, StreamClosedError)
+        self.assertEqual(client.metrics.dedup_failures, 1)
+        self.assertEqual(client._dedup_puts, {})
+        job_id = yield client.put(b'job', dedup_key='a')
+        self.assertIsInstance(job_id, int)
+        yield client.delete(job_id)
+        yield client.close()
+
+    @gen_test
+    def test_reconnect(self):
+        """Test re-establishing the tubes used and watched on re-connect"""
+        key = uuid.uuid4().hex
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        yield [client.use(key), client.watch(key), client.ignore('default')]
+        reconnected = Future()
+        client.set_reconnect_callback(lambda: reconnected.set_result(None))
+        client._stream.close()
+        # a put issued while the connection is down
+        put = client.put(b'job')
+        yield reconnected
+        watched = yield client.list_tubes_watched()
+        self.assertEqual(watched, [key])
+        used = yield client.list_tube_used()
+        self.assertEqual(used, key)
+        job_id = yield put
+        stats = yield client.stats_job(job_id)
+        self.assertEqual(stats['tube'], key)
+        yield client.delete(job_id)
+        yield client.close()
+
+    @gen_test
+    def test_socket_options(self):
+        """Test the options set on the client's TCP socket"""
+        client = beanstalkt.Client(io_loop=self.io_loop, tcp_keepalive=30)
+        yield client.connect()
+        sock = client._socket
+        self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY))
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                socket.SO_KEEPALIVE))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                    socket.TCP_KEEPIDLE), 30)
+        yield client.close()
+
+        client = beanstalkt.Client(io_loop=self.io_loop, tcp_nodelay=False)
+        yield client.connect()
+        self.assertFalse(client._socket.getsockopt(socket.IPPROTO_TCP,
+                socket.TCP_NODELAY))
+        self.assertFalse(client._socket.getsockopt(socket.SOL_SOCKET,
+                socket.SO_KEEPALIVE))
+        yield client.close()
+
+    @gen_test
+    def test_unix_socket(self):
+        """Test connecting over a Unix domain socket"""
+        class Server(TCPServer):
+            # answers a use command, and closes on quit, like beanstalkd
+            @gen.coroutine
+            def handle_stream(self, stream, address):
+                line = yield stream.read_until(b'\r\n')
+                yield stream.write(b'USING ' + line.split()[1] + b'\r\n')
+                yield stream.read_until(b'\r\n')
+                stream.close()
+
+        path = os.path.join(tempfile.mkdtemp(), 'beanstalkd.sock')
+        server = Server()
+        server.add_socket(bind_unix_socket(path))
+        try:
+            client = beanstalkt.Client('unix:' + path, io_loop=self.io_loop)
+            yield client.connect()
+            self.assertEqual(client._socket.family, socket.AF_UNIX)
+            tube = yield client.use('over-unix')
+            self.assertEqual(tube, 'over-unix')
+            yield client.close()
+        finally:
+            server.stop()
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+    @gen_test
+    def test_put_dedup(self):
+        """Test that puts with the same dedup key put a single job"""
+        key = uuid.uuid4().hex
+        yield self.btc.use(key)
+        job_ids = yield [self.btc.put(b'test job', dedup_key='a')
+                for _ in range(3)]
+        self.assertEqual(len(set(job_ids)), 1)
+        job_id = yield self.btc.put(b'test job', dedup_key='a')
+        self.assertEqual(job_id, job_ids[0])
+        self.assertEqual(self.btc.metrics.dedup_misses, 1)
+        self.assertEqual(self.btc.metrics.dedup_hits, 3)
+
+        # the same key in another tube is another job
+        yield self.btc.use('default')
+        other_id = yield self.btc.put(b'test job', dedup_key='a')
+        self.assertNotEqual(other_id, job_id)
+        yield [self.btc.delete(job_id), self.btc.delete(other_id)]
+
+    @gen_test
+    def test_rate_limit(self):
+        """Test that puts are throttled by a rate limit"""
+        key = uuid.uuid4().hex
+        yield self.btc.use(key)
+        self.btc.set_rate_limit(key, 20, burst=1)
+        start = time.time()
+        job_ids = yield [self.btc.put(b'test job') for _ in range(5)]
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        self.btc.set_rate_limit(key, None)
+        yield [self.btc.delete(job_id) for job_id in job_ids]
+
+    @gen_test
+    def test_rate_limit_held_back(self):
+        """Test that a throttled command only holds back the commands that
+        must stay in order with it"""
+        limited, other = uuid.uuid4().hex, uuid.uuid4().hex
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        yield [client.watch(limited), client.ignore('default')]
+        client.set_rate_limit(limited, 2, burst=1, command='reserve')
+        client.set_rate_limit(limited, 2, burst=1)
+        yield client.use(limited)
+        ids = yield [client.put(b'job') for _ in range(3)]
+        first = yield client.reserve(timeout=0)
+        yield client.reserve(timeout=0)
+        # the next reserve and put wait for a token
+        start = time.time()
+        reserved = client.reserve(timeout=0)
+        put = client.put(b'job')
+        # a touch of a reserved job, and a put into another tube, pass them
+        resp = yield client.touch(first.id)
+        self.assertIsNone(resp)
+        yield client.use(other)
+        other_id = yield client.put(b'job')
+        self.assertLess(time.time() - start, 0.2)
+        self.assertFalse(reserved.done() or put.done())
+        ids.append((yield put))
+        yield reserved
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        # the put held back was made into its own tube
+        stats = yield self.btc.stats_job(ids[-1])
+        self.assertEqual(stats['tube'], limited)
+        stats = yield self.btc.stats_job(other_id)
+        self.assertEqual(stats['tube'], other)
+        used = yield client.list_tube_used()
+        self.assertEqual(used, other)
+        yield [client.delete(job_id) for job_id in ids + [other_id]]
+        yield client.close()
+
+    @gen_test
+    def test_reserve_rate_limit(self):
+        """Test that reserve limits apply to the tube of the jobs reserved"""
+        limited, other = uuid.uuid4().hex, uuid.uuid4().hex
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        yield [client.watch(limited), client.watch(other),
+                client.ignore('default')]
+        client.set_rate_limit(limited, 10, burst=1, command='reserve')
+        for tube in (other, limited):
+            yield client.use(tube)
+            yield [client.put(b'job') for _ in range(4)]
+        # the jobs in the tube without a limit are not held back
+        start = time.time()
+        for _ in range(4):
+            job = yield client.reserve(timeout=0)
+            yield client.delete(job.id)
+        self.assertLess(time.time() - start, 0.1)
+        # the token for a job is taken after the reserve, so the first two
+        # reserves take the token in the bucket and the first token refilled
+        start = time.time()
+        for _ in range(4):
+            job = yield client.reserve(timeout=0)
+            yield client.delete(job.id)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        # reserving from a given tube needs no lookup of the job's tube
+        yield client.use(limited)
+        ids = yield [client.put(b'job') for _ in range(2)]
+        commands = client.metrics.commands
+        for _ in ids:
+            job = yield client.reserve(timeout=0, tubes=[limited])
+            yield client.delete(job.id)
+        self.assertEqual(client._watching, set([limited]))
+        # an ignore, and a reserve and delete for each job
+        self.assertEqual(client.metrics.commands - commands, 5)
+        # if the tube cannot be looked up, the tightest limit is charged
+        client.set_rate_limit(limited, 1, burst=1, command='reserve')
+        client.set_rate_limit(other, 1000, command='reserve')
+        yield client._charge_reserve(0, frozenset([limited, other]), None)
+        self.assertLess(client._limits[('reserve', limited)]._tokens, 1)
+        yield client.close()
+
+    @gen_test
+    def test_tracer(self):
+        """Test tracing jobs with an envelope from put to delete"""
+        key = uuid.uuid4().hex
+        spans = []
+        tracer = beanstalkt.Tracer(on_span=spans.append)
+        client = beanstalkt.Client(io_loop=self.io_loop, tracer=tracer)
+        yield client.connect()
+        yield [client.use(key), client.watch(key), client.ignore('default')]
+        job_id = yield client.put(b'test job', trace_id=42)
+
+        # the envelope is seen by a client without a tracer
+        job = yield self.btc.peek(job_id)
+        self.assertNotEqual(job['body'], b'test job')
+
+        job = yield client.reserve()
+        self.assertEqual(job['body'], b'test job')
+        self.assertEqual(job['trace_id'], 42)
+        yield client.delete(job_id)
+
+        # a body with an invalid envelope is read as is
+        from beanstalkt.envelope import HEADER, MAGIC, VERSION
+        body = HEADER.pack(MAGIC, VERSION, 0, 1, 2) + b'\xff\xfe'
+        other_id = yield self.btc.put(body)
+        job = yield client.peek(other_id)
+        self.assertEqual(job['body'], body)
+        yield self.btc.delete(other_id)
+        yield client.close()
+
+        self.assertEqual(tracer.queue_wait[key].count, 1)
+        self.assertEqual(tracer.latency[key].count, 1)
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0].outcome, 'deleted')
+        self.assertEqual(spans[0].trace_id, 42)
+
+    def test_tracer_invalid_envelope(self):
+        """Test that bodies without a valid envelope are left as is"""
+        from beanstalkt.envelope import HEADER, MAGIC, VERSION
+        tracer = beanstalkt.Tracer()
+        valid = tracer.wrap(b'body', 'tube')
+        bodies = [b'\xbe\x01' + b'\xff' * 40, valid[:HEADER.size + 2],
+                valid[:len(MAGIC)] + b'\x09' + valid[len(MAGIC) + 1:],
+                HEADER.pack(MAGIC, VERSION, 0, 1, 2) + b'\xff\xfe']
+        for body in bodies:
+            job = dict(id=1, body=body)
+            tracer.unwrap(job, reserved=True)
+            self.assertEqual(job, dict(id=1, body=body))
+        job = dict(id=1, body=valid)
+        tracer.unwrap(job)
+        self.assertEqual(job['body'], b'body')
+
+    @gen_test
+    def test_record_replay(self):
+        """Test recording the traffic of a client, and replaying it"""
+        key = uuid.uuid4().hex
+        recording = io.BytesIO()
+        recorder = beanstalkt.Recorder(recording)
+        client = beanstalkt.Client(io_loop=self.io_loop, recorder=recorder)
+        yield client.connect()
+        yield [client.use(key), client.watch(key), client.ignore('default')]
+        job_id = yield client.put(b'test job')
+        job = yield client.reserve()
+        yield client.delete(job['id'])
+        # a job with an empty body
+        yield client.put(b'')
+        job = yield client.reserve()
+        self.assertEqual(job['body'], b'')
+        yield client.delete(job['id'])
+        yield client.close()
+        self.assertEqual(recorder.records, 18)
+
+        replayer = beanstalkt.Replayer(io.BytesIO(recording.getvalue()),
+                speed=0, io_loop=self.io_loop)
+        report = yield replayer.run()
+        self.assertEqual(report['requests'], 9)
+        self.assertEqual(report['divergent'], 0)
+        self.assertNotEqual(replayer.job_ids[job_id], job_id)
+        self.assertEqual(report['commands']['reserve']['count'], 2)
+
+    @gen_test
+    def test_inspector(self):
+        """Test inspecting the jobs at the peek points of a tube"""
+        key = uuid.uuid4().hex
+        yield self.btc.use(key)
+        ids = yield [self.btc.put(b'job'),
+                self.btc.put(b'delayed job', delay=60)]
+        inspector = beanstalkt.Inspector(self.btc, rate=100)
+        yield inspector.inspect_tubes([key])
+        self.assertEqual(self.btc._using, key)
+        self.assertEqual(inspector.inspected, 2)
+        ready = inspector.histograms[(key, 'ready')]
+        self.assertEqual(ready.size.max, 3)
+        delayed = inspector.histograms[(key, 'delayed')]
+        self.assertEqual(delayed.ttr.count, 1)
+        self.assertEqual(delayed.size.max, 11)
+        yield [self.btc.delete(job_id) for job_id in ids]
+
+    @gen_test
+    def test_worker_executor(self):
+        """Test a worker running handlers in a thread pool"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        key = uuid.uuid4().hex
+        bodies = []
+        handled = Future()
+
+        def handler(body):
+            bodies.append(body)
+            if len(bodies) == 3:
+                self.io_loop.add_callback(handled.set_result, None)
+            if body == b'release':
+                raise beanstalkt.ReleaseJob(delay=1)
+            elif body == b'bury':
+                raise beanstalkt.BuryJob()
+
+        yield self.btc.use(key)
+        job1_id = yield self.btc.put(b'delete')
+        job2_id = yield self.btc.put(b'release')
+        job3_id = yield self.btc.put(b'bury')
+
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        worker = beanstalkt.Worker(client, max_jobs=2, reserve_timeout=0)
+        worker.register(key, handler, executor=ThreadPoolExecutor(2))
+        worker.start()
+        # wait until the jobs have been handled and deleted/released/buried
+        yield handled
+        yield worker.stop()
+        yield client.close()
+
+        self.assertEqual(sorted(bodies), [b'bury', b'delete', b'release'])
+        resp = yield self.btc.peek(job1_id)
+        self.assertIsInstance(resp, beanstalkt.CommandFailed)
+        resp = yield self.btc.peek_delayed()
+        self.assertEqual(resp['id'], job2_id)
+        resp = yield self.btc.peek_buried()
+        self.assertEqual(resp['id'], job3_id)
+        yield self.btc.delete(job2_id)
+        yield self.btc.delete(job3_id)
+
+    @gen_test
+    def test_worker_responsive(self):
+        """Test that deletes do not wait behind the worker's reserve"""
+        key = uuid.uuid4().hex
+        finished = Future()
+        handled = []
+
+        @gen.coroutine
+        def handler(body):
+            yield gen.sleep(0.1)
+            handled.append(time.time())
+
+        client = beanstalkt.Client(io_loop=self.io_loop,
+                tracer=beanstalkt.Tracer(on_span=finished.set_result))
+        yield client.connect()
+        yield client.use(key)
+        yield client.put(b'job')
+        worker = beanstalkt.Worker(client, max_jobs=2, reserve_timeout=1)
+        worker.register(key, handler)
+        worker.start()
+        span = yield finished
+        yield worker.stop()
+        yield client.close()
+        self.assertEqual(span.outcome, 'deleted')
+        self.assertLess(span.finished_at - handled[0], 0.5)
+
+    @gen_test
+    def test_worker_retry(self):
+        """Test retrying a failing job, and moving it to a dead-letter tube"""
+        yield self._worker_retry()
+
+    @gen_test
+    def test_worker_retry_pooled(self):
+        """Test moving a job with a pooled body to a dead-letter tube"""
+        yield self._worker_retry(beanstalkt.BufferPool())
+
+    @gen.coroutine
+    def _worker_retry(self, buffer_pool=None):
+        key = uuid.uuid4().hex
+        attempts = []
+
+        failed = Future()
+
+        def handler(body):
+            attempts.append(body)
+            if len(attempts) == 3:
+                failed.set_result(None)
+            raise ValueError('failed')
+
+        client = beanstalkt.Client(io_loop=self.io_loop,
+                tracer=beanstalkt.Tracer(), buffer_pool=buffer_pool)
+        yield client.connect()
+        yield client.use(key)
+        job_id = yield client.put(b'failing', ttr=30, trace_id=7)
+        lookups = []
+        stats_job = client.stats_job
+        client.stats_job = lambda job_id: (lookups.append(job_id) or
+                stats_job(job_id))
+        worker = beanstalkt.Worker(client, reserve_timeout=0)
+        retry = beanstalkt.RetryPolicy(max_attempts=3, base_delay=0,
+                dead_letter=key + '-dead')
+        worker.register(key, handler, retry=retry)
+        worker.start()
+        yield failed
+        yield worker.stop()
+
+        self.assertEqual(len(attempts), 3)
+        # the stats of the job are looked up once, after the first attempt
+        self.assertEqual(lookups, [job_id])
+        self.assertEqual(worker._failures, {})
+        resp = yield client.peek(job_id)
+        self.assertIsInstance(resp, beanstalkt.CommandFailed)
+        # the job keeps its time to run and its trace id
+        yield client.use(key + '-dead')
+        job = yield client.peek_ready()
+        self.assertEqual(job['body'], b'failing')
+        self.assertEqual(job['trace_id'], 7)
+        stats = yield client.stats_job(job['id'])
+        self.assertEqual(stats['ttr'], 30)
+        yield client.delete(job['id'])
+        yield client.close()
+
+    @gen_test(timeout=10)
+    def test_bench(self):
+        """Test the rates reported by the benchmark"""
+        from beanstalkt.bench import Bench
+        bench = Bench(duration=0.3, tube_prefix=uuid.uuid4().hex,
+                io_loop=self.io_loop)
+        report = yield bench.run()
+        self.assertGreater(report['puts'], 0)
+        self.assertEqual(report['reserves'], report['puts'])
+        # the consumers' final reserve timeout is not counted in the rates
+        self.assertGreaterEqual(report['elapsed'], 1)
+        self.assertLess(report['put_elapsed'], 0.5)
+        self.assertLess(report['reserve_elapsed'], 0.5)
+        self.assertAlmostEqual(report['put_rate'],
+                report['puts'] / report['put_elapsed'])
+
+    def test_retry_delay(self):
+        """Test the exponential delays of a retry policy"""
+        retry = beanstalkt.RetryPolicy(base_delay=2, factor=3, max_delay=60)
+        self.assertEqual([retry.delay(n) for n in range(1, 6)],
+                [2, 6, 18, 54, 60])
+        retry.jitter = 0.5
+        for _ in range(100):
+            self.assertTrue(27 <= retry.delay(4) <= 54)
+        # a delay is at least a second, unless retrying at once
+        retry = beanstalkt.RetryPolicy(base_delay=0.2, jitter=1)
+        self.assertEqual(set(retry.delay(1) for _ in range(100)), set([1]))
+        retry = beanstalkt.RetryPolicy(base_delay=0)
+        self.assertEqual(retry.delay(3), 0)
+
+    def test_sync_client(self):
+        """Test the blocking client shared by threads"""
+        import threading
+        from beanstalkt.sync import SyncClient, Timeout
+
+        key = uuid.uuid4().hex
+        client = SyncClient(connections=2, timeout=5)
+        ids = []
+        threads = [threading.Thread(target=lambda: ids.append(
+                client.put(b'job', tube=key))) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(ids)), 8)
+
+        job = client.reserve(timeout=0, tubes=[key])
+        self.assertIn(job['id'], ids)
+        # released on the connection that reserved the job
+        self.assertIsNone(client.release(job['id']))
+        reserved = [client.reserve(timeout=0, tubes=[key]) for _ in ids]
+        self.assertEqual(sorted(j['id'] for j in reserved), sorted(ids))
+        for j in reserved:
+            self.assertIsNone(client.delete(j['id']))
+        self.assertIsInstance(client.reserve(timeout=0, tubes=[key]),
+                beanstalkt.TimedOut)
+        self.assertRaises(Timeout, client.stats, timeout=0)
+        self.assertRaises(ValueError, client.put, b'job', tube='-bad')
+        client.close()
+
+    def _run_cmd(self, args, stdin=b''):
+        # run the command line client, returns the exit status and output
+        import subprocess
+        import sys
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        process = subprocess.Popen([sys.executable, '-m', 'beanstalkt.cmd'] +
+                args, cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        output = process.communicate(stdin)[0]
+        return process.returncode, output.decode('utf8')
+
+    def test_session(self):
+        """Test running a pipelined session script"""
+        import json
+
+        key = uuid.uuid4().hex
+        script = '\n'.join(line.format(key) for line in [
+            'put -u {} first', 'put -u {} second',
+            'reserve bury -t 0 -i -w {}', 'peek-buried -u {}',
+            'reserve delete -t 0', 'peek-ready -u {}', 'stats-tube {}'])
+        _, output = self._run_cmd(['session', '--pipeline', '4',
+                '--keep-going'], script.encode('utf8'))
+        lines = output.splitlines()
+        records = [json.loads(line) for line in lines if line]
+        self.assertEqual(len(records), 7)
+        ids = [r['result'] for r in records[:2]]
+        self.assertEqual(records[2]['result']['id'], ids[0])
+        self.assertEqual(records[3]['result']['id'], ids[0])
+        self.assertEqual(records[4]['result']['id'], ids[1])
+        self.assertIn('NOT_FOUND', records[5]['error'])
+        self.assertEqual(records[6]['result']['current-jobs-buried'], 1)
+        self.btc.delete(ids[0], callback=self.stop)
+        self.wait()
+
+    def test_bulk_commands(self):
+        """Test the dry run and options of the bulk commands"""
+        key = uuid.uuid4().hex
+        for _ in range(3):
+            self._run_cmd(['put', '--use', key, 'job'])
+        # a dry run shows the number of jobs up to the limit
+        self.assertEqual(self._run_cmd(['drain', key, '--dry-run']),
+                (0, '3\n'))
+        self.assertEqual(self._run_cmd(['drain', key, '--dry-run',
+                '--limit', '2']), (0, '2\n'))
+        # a purge deletes a job per round trip
+        status, _ = self._run_cmd(['purge-buried', key, '--in-flight', '5'])
+        self.assertEqual(status, 2)
+        self.assertEqual(self._run_cmd(['drain', key, '--in-flight', '2']),
+                (0, ''))
+        self.btc.use(key, callback=self.stop)
+        self.wait()
+        self.btc.peek_ready(callback=self.stop)
+        self.assertIsInstance(self.wait(), beanstalkt.CommandFailed)
+
+    def test_sync_client_untimed_reserve(self):
+        """Test that reserves without timeout leave a connection free"""
+        import threading
+        from beanstalkt.sync import SyncClient
+
+        key = uuid.uuid4().hex
+        client = SyncClient(connections=2, timeout=5)
+        reserved = []
+        threads = [threading.Thread(target=lambda: reserved.append(
+                client.reserve(tubes=[key]))) for _ in range(2)]
+        for t in threads:
+            t.start()
+        while sum(client._untimed) < 2:
+            time.sleep(0.01)
+        self.assertEqual(sorted(client._untimed), [0, 2])
+        # other commands are not stuck behind the reserves
+        job_id = client.put(b'job', tube=key + '-other', timeout=1)
+        self.assertIsNone(client.delete(job_id, timeout=1))
+        ids = [client.put(b'job', tube=key, timeout=1) for _ in threads]
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(j['id'] for j in reserved), sorted(ids))
+        for j in reserved:
+            self.assertIsNone(client.delete(j['id']))
+        client.close()
+
+        client = SyncClient(connections=1, timeout=5)
+        self.assertRaises(ValueError, client.reserve, tubes=[key])
+        client.close()
+
+    @gen_test
+    def test_fair_reserve(self):
+        """Test reserving from tubes in proportion to their weights"""
+        key = uuid.uuid4().hex
+        tubes = [key + '-a', key + '-b']
+        for tube in tubes:
+            yield self.btc.use(tube)
+            yield [self.btc.put(b'job') for _ in range(6)]
+
+        client = beanstalkt.Client(io_loop=self.io_loop)
+        yield client.connect()
+        fair = beanstalkt.FairReserver(client, {tubes[0]: 1, tubes[1]: 2})
+        jobs = []
+        for _ in range(6):
+            job = yield fair.reserve(timeout=0)
+            jobs.append(job)
+            yield client.delete(job['id'])
+        self.assertEqual([j['tube'] for j in jobs].count(tubes[1]), 4)
+        self.assertEqual(client._watching, set([tubes[1]]))
+        self.assertEqual(fair.metrics.jobs, 6)
+        self.assertEqual(fair.round_trips(), 1)
+
+        # empty the tubes
+        while True:
+            job = yield fair.reserve(timeout=0)
+            if isinstance(job, beanstalkt.TimedOut):
+                break
+            yield client.delete(job['id'])
+        self.assertEqual(fair.metrics.jobs, 12)
+        yield client.close()
+
+    @gen_test
+    def test_buffer_pool(self):
+        """Test reading the bodies of reserved jobs into pooled buffers"""
+        tube = uuid.uuid4().hex
+        pool = beanstalkt.BufferPool(max_buffers=2, max_size=8192)
+        client = beanstalkt.Client(io_loop=self.io_loop, buffer_pool=pool)
+        yield client.connect()
+        yield [client.use(tube), client.watch(tube), client.ignore('default')]
+        bodies = [b'first', b'second', b'x' * 10000]
+        for body in bodies:
+            yield client.put(body)
+        for body in bodies:
+            job = yield client.reserve(timeout=0)
+            self.assertIsInstance(job.body, memoryview)
+            self.assertEqual(job.body.tobytes(), body)
+            yield client.delete(job.id)
+        self.assertEqual(client.metrics.bodies, 3)
+        self.assertEqual(len(client._buffers), 0)
+        if hasattr(client._stream, 'read_into'):
+            # the buffer of the first job is reused, the large body is read
+            # without the pool
+            self.assertEqual((pool.allocations, pool.reuses), (1, 1))
+            self.assertEqual(client.metrics.body_allocations, 2)
+        yield client.close()
+
+        # the buffers are bounded in number and size
+        buffers = [pool.acquire(100) for _ in range(3)]
+        self.assertEqual(len(buffers[0]), beanstalkt.buffers.MIN_SIZE)
+        self.assertIsNone(pool.acquire(10000))
+        for buf in buffers:
+            pool.release(buf)
+        self.assertEqual(pool.discarded, 1)
+
+    @gen_test
+    def test_buffer_pool_reconnect(self):
+        """Test dropping the buffers of jobs no longer reserved"""
+        tube = uuid.uuid4().hex
+        pool = beanstalkt.BufferPool()
+        client = beanstalkt.Client(io_loop=self.io_loop, buffer_pool=pool)
+        yield client.connect()
+        yield [client.use(tube), client.watch(tube), client.ignore('default')]
+        yield [client.put(b'held'), client.put(b'expiring', ttr=1)]
+        held = yield client.reserve(timeout=0)
+        expired = yield client.reserve(timeout=0)
+        pooled = hasattr(client._stream, 'read_into')
+        self.assertEqual(len(client._buffers), 2 if pooled else 0)
+        # the job is no longer reserved by the client when its TTR expires
+        yield gen.sleep(1.1)
+        resp = yield client.touch(expired.id)
+        self.assertIsInstance(resp, beanstalkt.CommandFailed)
+        self.assertEqual(list(client._buffers), [held.id] if pooled else [])
+        # the jobs reserved on a lost connection are released by the server
+        reconnected = Future()
+        client.set_reconnect_callback(lambda: reconnected.set_result(None))
+        client._stream.close()
+        yield reconnected
+        self.assertEqual(client._buffers, {})
+        # the body is not overwritten by a job reserved later
+        job = yield client.reserve(timeout=0)
+        self.assertEqual(job.body.tobytes(), b'expiring')
+        self.assertEqual(held.body.tobytes(), b'held')
+        yield [client.delete(job.id), client.delete(held.id)]
+        yield client.close()
 
 if __name__ == '__main__':
     import sys
     if len(sys.argv) == 1:
-        sys.argv.append('bt_test')
+        sys.argv.append('beanstalkt.bt_test')
     main()
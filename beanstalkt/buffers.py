@@ -0,0 +1,55 @@
+"""beanstalkt.buffers - Reusable buffers for job bodies
+
+A client with a buffer pool reads the bodies of reserved jobs into buffers
+taken from the pool, instead of allocating new byte strings for every job,
+and hands the bodies out as memoryviews of the buffers. A buffer goes back to
+the pool when the client deletes, releases or buries the job.
+"""
+
+MIN_SIZE = 4096  # Min. size (in bytes) of a buffer
+
+
+class BufferPool(object):
+    """A pool holding at most `max_buffers` free buffers (bytearrays), for
+    bodies of at most `max_size` bytes.
+
+    The size of a buffer is rounded up to a power of two, so that a buffer
+    can be reused for bodies of about the same size. A pool can be shared by
+    the clients of an IOLoop.
+    """
+
+    def __init__(self, max_buffers=64, max_size=1024 * 1024):
+        self.max_buffers = max_buffers
+        self.max_size = max_size
+        self._free = {}  # size -> list of free buffers
+        self._count = 0  # number of free buffers
+        self.allocations = 0
+        self.reuses = 0
+        self.discarded = 0
+
+    def acquire(self, size):
+        """Returns a buffer of at least size bytes, or None if size is larger
+        than max_size.
+        """
+        if size > self.max_size:
+            return None
+        capacity = MIN_SIZE
+        while capacity < size:
+            capacity *= 2
+        free = self._free.get(capacity)
+        if free:
+            self._count -= 1
+            self.reuses += 1
+            return free.pop()
+        self.allocations += 1
+        return bytearray(capacity)
+
+    def release(self, buf):
+        """Return the buffer to the pool. If the pool is full, the buffer is
+        discarded.
+        """
+        if self._count >= self.max_buffers:
+            self.discarded += 1
+            return
+        self._free.setdefault(len(buf), []).append(buf)
+        self._count += 1
@@ -1,8 +1,14 @@
 import argparse
 import json
+import shlex
 import signal
+import sys
+import time
+
+from collections import deque
 
 import tornado.ioloop
+from tornado.gen import coroutine, Return, Task
 
 import beanstalkt
 
@@ -15,15 +21,40 @@ def main():
     # get arguments and call the client
     #
 
-    parser = argparse.ArgumentParser(
-            description='Beanstalkd command line client')
+    parser = make_parser()
+    args = parser.parse_args()
+    servers = args.host or ['localhost:11300']
+    if len(servers) > 1 and args.func != top:
+        parser.error('--host: only top takes several servers')
+    client.host, client.port = parse_server(servers[0])
+    if args.func == put and (args.body is None) == (args.from_file is None
+            and not args.stdin):
+        parser.error('put: give either a body, --from-file or --stdin')
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    options = vars(args)
+    del options['host']
+    if args.func == top:
+        options['servers'] = servers
+    args.func(**options)
+
+
+def make_parser(parser_class=argparse.ArgumentParser):
+    # the parser of the command line, also used for the lines of a session
+    parser = parser_class(description='Beanstalkd command line client')
+    parser.add_argument('-H', '--host', action='append',
+            metavar='HOST:PORT', help='server to connect to, "unix:PATH" '
+            'for a Unix domain socket (default is localhost:11300); top '
+            'takes the option several times, to monitor several servers')
 
     subparsers = parser.add_subparsers()
 
     # put
     parser_put = subparsers.add_parser('put', help='put a job (string) into '
-            'the queue')
-    parser_put.add_argument('body', help='string with job data')
+            'the queue, or put jobs read from a file or stdin')
+    parser_put.add_argument('body', nargs='?', help='string with job data')
     parser_put.add_argument('-p', '--priority', type=int, default=2 ** 31)
     parser_put.add_argument('-u', '--use', default='default',
             help='tube to use')
@@ -31,6 +62,22 @@ def main():
             help='delay in seconds before moving job to the ready queue')
     parser_put.add_argument('-t', '--ttr', default=120, type=int,
             help='Time To Run in seconds')
+    parser_put.add_argument('-f', '--from-file', metavar='FILE',
+            help='put a job for each record in the file')
+    parser_put.add_argument('--stdin', action='store_true',
+            help='put a job for each record read from stdin')
+    parser_put.add_argument('--format', choices=['lines', 'length', 'json'],
+            default='lines', help='format of the records: "lines" is a job '
+            'body per line (empty lines are skipped), "length" is a line with '
+            'the body length in bytes followed by the body and a newline, '
+            '"json" is a JSON string or object (with key body and optional '
+            'keys priority, delay and ttr) per line')
+    parser_put.add_argument('-n', '--in-flight', type=int, default=1000,
+            help='max. number of puts waiting for a reply, when putting jobs '
+            'from a file or stdin')
+    parser_put.add_argument('--failed', metavar='FILE',
+            help='write the line number and error of records that failed, '
+            'as JSON lines, to the file')
     parser_put.set_defaults(func=put)
 
     # reserve and delete/release/bury
@@ -128,16 +175,154 @@ def main():
         'the queue')
     parser_pause_tube.set_defaults(func=pause_tube)
 
-    args = parser.parse_args()
-
-    signal.signal(signal.SIGINT, stop)
-    signal.signal(signal.SIGTERM, stop)
-
-    args.func(**vars(args))
+    # drain, purge-buried, purge-delayed and kick-all
+    bulk_help = {
+        'drain': 'reserve and delete all ready jobs in a tube',
+        'purge-buried': 'delete all buried jobs in a tube',
+        'purge-delayed': 'delete all delayed jobs in a tube',
+        'kick-all': 'kick all buried jobs, and then all delayed jobs, into '
+                'the ready queue of a tube'}
+    for name in ['drain', 'purge-buried', 'purge-delayed', 'kick-all']:
+        parser_bulk = subparsers.add_parser(name, help=bulk_help[name])
+        parser_bulk.add_argument('tube', help='name of the tube')
+        parser_bulk.add_argument('-l', '--limit', type=int, default=None,
+                help='max. number of jobs to process')
+        parser_bulk.add_argument('--dry-run', action='store_true',
+                help='only show the number of jobs that would be processed')
+        if name in ('drain', 'kick-all'):
+            # a purge deletes a job per round trip, as the server only
+            # reveals the next buried or delayed job
+            parser_bulk.add_argument('-n', '--in-flight', type=int,
+                    default=1000, help='max. number of jobs processed in '
+                    'each round trip to the server')
+        parser_bulk.set_defaults(func=bulk_command, command=name)
+
+    # top
+    parser_top = subparsers.add_parser('top',
+            help='show a refreshing view of the tubes of one or more servers')
+    parser_top.add_argument('-i', '--interval', type=float, default=2,
+            help='seconds between samples')
+    parser_top.add_argument('-o', '--sort', choices=TOP_COLUMNS,
+            default='ready', help='column to sort the tubes by')
+    parser_top.add_argument('-t', '--tube', action='append',
+            help='tube to show, apply multiple times to show several tubes '
+            '(default is all tubes, which are listed at each sample)')
+    parser_top.add_argument('-n', '--iterations', type=int, default=None,
+            help='number of samples to show before exiting')
+    parser_top.set_defaults(func=top)
+
+    # bench
+    parser_bench = subparsers.add_parser('bench',
+            help='generate load against a server, and report throughput, '
+            'latency and server stats deltas')
+    parser_bench.add_argument('-p', '--producers', type=int, default=1,
+            help='number of producers')
+    parser_bench.add_argument('-c', '--consumers', type=int, default=1,
+            help='number of consumers')
+    parser_bench.add_argument('--connections', type=int, default=None,
+            help='number of connections shared by the producers and '
+            'consumers (default is a connection each)')
+    parser_bench.add_argument('-b', '--body-size', default='100',
+            help='job body size in bytes, "uniform:MIN:MAX" or "exp:MEAN"')
+    parser_bench.add_argument('--tubes', type=int, default=1,
+            help='number of tubes')
+    parser_bench.add_argument('--priority-range', default='{0}:{0}'.format(
+            2 ** 31), metavar='MIN:MAX', help='range of job priorities')
+    parser_bench.add_argument('--delayed', type=float, default=0.0,
+            help='fraction of the jobs to delay')
+    parser_bench.add_argument('--delay', type=int, default=1,
+            help='delay in seconds of the delayed jobs')
+    parser_bench.add_argument('-d', '--duration', type=float, default=10,
+            help='duration in seconds')
+    parser_bench.add_argument('-n', '--in-flight', type=int, default=1,
+            help='max. number of puts waiting for a reply, per producer')
+    parser_bench.add_argument('--json', action='store_true', dest='as_json',
+            help='output the report as JSON')
+    parser_bench.add_argument('--no-nodelay', action='store_false',
+            dest='tcp_nodelay', help='leave Nagle\'s algorithm enabled')
+    parser_bench.add_argument('--keepalive', type=int, default=None,
+            metavar='SECONDS', help='enable TCP keepalive with the idle time')
+    parser_bench.add_argument('--sndbuf', type=int, default=None,
+            metavar='BYTES', help='size of the socket send buffer')
+    parser_bench.add_argument('--rcvbuf', type=int, default=None,
+            metavar='BYTES', help='size of the socket receive buffer')
+    parser_bench.add_argument('--read-chunk-size', type=int, default=None,
+            metavar='BYTES', help='size of each read from the socket')
+    parser_bench.set_defaults(func=bench)
+
+    # bench-sync
+    parser_bench_sync = subparsers.add_parser('bench-sync',
+            help='compare threads sharing a SyncClient with threads having a '
+            'blocking connection each')
+    parser_bench_sync.add_argument('-t', '--threads', type=int, default=16,
+            help='number of threads')
+    parser_bench_sync.add_argument('-c', '--connections', type=int,
+            default=2, help='number of connections of the SyncClient')
+    parser_bench_sync.add_argument('-b', '--body-size', default='100',
+            help='job body size in bytes, "uniform:MIN:MAX" or "exp:MEAN"')
+    parser_bench_sync.add_argument('-d', '--duration', type=float,
+            default=10, help='duration in seconds of each run')
+    parser_bench_sync.add_argument('--json', action='store_true',
+            dest='as_json', help='output the report as JSON')
+    parser_bench_sync.set_defaults(func=bench_sync)
+
+    # inspect
+    parser_inspect = subparsers.add_parser('inspect',
+            help='inspect jobs with pipelined stats-job and peek commands, '
+            'and show the distributions of age, ttr, releases and body size '
+            'per tube and state')
+    parser_inspect.add_argument('-t', '--tube', action='append',
+            help='tube to inspect, apply multiple times to inspect several '
+            'tubes (default is all tubes)')
+    parser_inspect.add_argument('-r', '--range', metavar='FIRST:LAST',
+            help='inspect the jobs with ids in the range (default is the jobs '
+            'at the peek points of the tubes)')
+    parser_inspect.add_argument('-c', '--concurrency', type=int, default=10,
+            help='max. number of jobs being inspected at a time')
+    parser_inspect.add_argument('--rate', type=float, default=None,
+            help='max. number of jobs inspected per second')
+    parser_inspect.add_argument('--no-bodies', action='store_false',
+            dest='bodies', help='do not peek at the jobs for the body size')
+    parser_inspect.add_argument('--json', action='store_true', dest='as_json',
+            help='output the report as JSON')
+    parser_inspect.set_defaults(func=inspect)
+
+    # replay
+    parser_replay = subparsers.add_parser('replay',
+            help='replay the traffic recorded by clients against a server, '
+            'and report divergent replies and latencies')
+    parser_replay.add_argument('file', help='the recording')
+    parser_replay.add_argument('--speed', type=float, default=1.0,
+            help='speed relative to the recorded timing, 0 replays as fast '
+            'as possible')
+    parser_replay.add_argument('-n', '--in-flight', type=int, default=100,
+            help='max. number of requests waiting for a reply, per '
+            'connection, when replaying as fast as possible')
+    parser_replay.add_argument('--reserve-timeout', type=int, default=1,
+            help='timeout in seconds of the reserves, when replaying as fast '
+            'as possible')
+    parser_replay.add_argument('--json', action='store_true', dest='as_json',
+            help='output the report as JSON')
+    parser_replay.set_defaults(func=replay)
+
+    # session
+    parser_session = subparsers.add_parser('session',
+            help='run commands read from a file or stdin, one per line, over '
+            'a single connection, and output the results as JSON lines')
+    parser_session.add_argument('file', nargs='?', default='-',
+            help='file with the commands (default is stdin)')
+    parser_session.add_argument('-n', '--pipeline', type=int, default=1,
+            help='max. number of commands waiting for a reply')
+    parser_session.add_argument('-k', '--keep-going', action='store_true',
+            help='continue with the next command after an error (default is '
+            'to stop at the first error)')
+    parser_session.set_defaults(func=session)
+
+    return parser
 
 
 def start(callback):
-    client.connect(callback)
+    client.connect(callback=lambda _: callback())
     ioloop.start()
 
 
@@ -153,30 +338,592 @@ def success(callback, last=True):
 
 
 def stop(*args):
-    client.close(ioloop.stop)
+    client.close(callback=lambda _: ioloop.stop())
+
+
+def run(func):
+    # connect and run the coroutine, stop when it is done
+    def done(future):
+        try:
+            future.result()
+        except Exception as e:
+            print(e)
+        stop()
+    start(lambda: ioloop.add_future(func(), done))
+
+
+class Progress(object):
+    """Show the number of items processed and the rate on stderr."""
+
+    def __init__(self, what, interval=1):
+        self.what = what
+        self.interval = interval
+        self.count = 0
+        self.failed = 0
+        self._start = self._shown = time.time()
+
+    def add(self, count=1, failed=0):
+        self.count += count
+        self.failed += failed
+        if time.time() - self._shown >= self.interval:
+            self.show()
+
+    def show(self, end=''):
+        self._shown = time.time()
+        rate = self.count / max(self._shown - self._start, 1e-6)
+        sys.stderr.write('\r{} {}, {:.0f}/s, {} failed{}'.format(self.count,
+                self.what, rate, self.failed, end))
+        sys.stderr.flush()
+
+    def done(self):
+        self.show('\n')
+
+
+def read_records(source, format):
+    # generate (line number, body, put options) from the records in source
+    line_no = 0
+    for line in iter(source.readline, b''):
+        line_no += 1
+        if format == 'lines':
+            body = line.rstrip(b'\r\n')
+            if body:
+                yield line_no, body, {}
+        elif format == 'length':
+            try:
+                size = int(line)
+            except ValueError:
+                raise ValueError('line {}: invalid length'.format(line_no))
+            body = source.read(size + 1)[:size]
+            if len(body) < size:
+                raise ValueError('line {}: unexpected end of input'.format(
+                        line_no))
+            line_no += body.count(b'\n') + 1
+            yield line_no, body, {}
+        elif line.strip():
+            try:
+                record = json.loads(line.decode('utf8'))
+                if not isinstance(record, dict):
+                    record = dict(body=record)
+                options = dict((k, int(record[k])) for k in
+                        ('priority', 'delay', 'ttr') if k in record)
+                yield line_no, record['body'].encode('utf8'), options
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                yield line_no, None, e
+
+
+@coroutine
+def bulk_put(source, format, priority, use, delay, ttr, in_flight, failed):
+    # put jobs read from source, with a bounded number of puts in flight
+    progress = Progress('jobs put')
+    pending = deque()
+    failed_file = failed and open(failed, 'w')
+
+    def report(line_no, error):
+        progress.add(0, 1)
+        if failed_file:
+            failed_file.write(json.dumps(dict(line=line_no,
+                    error=str(error))) + '\n')
+
+    @coroutine
+    def wait_oldest():
+        line_no, future = pending.popleft()
+        resp = yield future
+        if isinstance(resp, Exception):
+            report(line_no, resp)
+        else:
+            progress.add()
+
+    yield client.use(use)
+    try:
+        for line_no, body, options in read_records(source, format):
+            if body is None:
+                report(line_no, options)
+                continue
+            kwargs = dict(priority=priority, delay=delay, ttr=ttr)
+            kwargs.update(options)
+            pending.append((line_no, client.put(body, **kwargs)))
+            if len(pending) >= in_flight:
+                yield wait_oldest()
+        while pending:
+            yield wait_oldest()
+    finally:
+        progress.done()
+        if failed_file:
+            failed_file.close()
+
+
+@coroutine
+def drain(tube, limit, in_flight):
+    # reserve jobs with pipelined reserve-with-timeout 0 commands, and delete
+    # the jobs reserved in a round in the next round trip
+    progress = Progress('jobs deleted')
+    yield client.watch(tube)
+    if tube != 'default':
+        yield client.ignore('default')
+    jobs = []
+    reserved = 0
+    done = False
+    while jobs or not done:
+        n = 0
+        if not done:
+            n = in_flight
+            if limit is not None:
+                n = min(n, limit - reserved)
+        results = yield ([client.delete(job.id) for job in jobs] +
+                [client.reserve(0) for _ in range(n)])
+        deleted, results = results[:len(jobs)], results[len(jobs):]
+        failed = sum(isinstance(r, Exception) for r in deleted)
+        progress.add(len(deleted) - failed, failed)
+        jobs = [r for r in results if not isinstance(r, Exception)]
+        errors = [r for r in results if isinstance(r, Exception)]
+        reserved += len(jobs)
+        if not n or errors or reserved == limit:
+            done = True
+        for error in errors:
+            if not isinstance(error, beanstalkt.TimedOut):
+                print(error)
+                break
+    progress.done()
+
+
+@coroutine
+def purge(tube, state, limit):
+    # delete the next job, and peek at the following job in the same round
+    # trip; the server only reveals the next buried or delayed job
+    progress = Progress('jobs deleted')
+    peek = client.peek_buried if state == 'buried' else client.peek_delayed
+    yield client.use(tube)
+    job = yield peek()
+    while not isinstance(job, Exception) and (limit is None or
+            progress.count + progress.failed < limit):
+        resp, job = yield [client.delete(job.id), peek()]
+        progress.add(*((0, 1) if isinstance(resp, Exception) else (1, 0)))
+    if (isinstance(job, Exception) and
+            not isinstance(job, beanstalkt.CommandFailed)):
+        print(job)
+    progress.done()
+
+
+@coroutine
+def kick_all(tube, limit, in_flight):
+    progress = Progress('jobs kicked')
+    yield client.use(tube)
+    while limit is None or progress.count < limit:
+        bound = in_flight
+        if limit is not None:
+            bound = min(bound, limit - progress.count)
+        kicked = yield client.kick(bound)
+        if isinstance(kicked, Exception):
+            print(kicked)
+            break
+        if not kicked:
+            break
+        progress.add(kicked)
+    progress.done()
+
+
+@coroutine
+def bulk_count(command, tube, limit):
+    # show the number of jobs the bulk command would process
+    stats = yield client.stats_tube(tube)
+    if isinstance(stats, Exception):
+        print(stats)
+        return
+    states = {'drain': ['ready'], 'purge-buried': ['buried'],
+            'purge-delayed': ['delayed'], 'kick-all': ['buried', 'delayed']}
+    count = sum(stats['current-jobs-' + state] for state in states[command])
+    print(count if limit is None else min(count, limit))
+
+
+def bulk_command(command, tube, limit, dry_run, func, in_flight=None):
+    if dry_run:
+        run(lambda: bulk_count(command, tube, limit))
+    elif command == 'drain':
+        run(lambda: drain(tube, limit, in_flight))
+    elif command == 'kick-all':
+        run(lambda: kick_all(tube, limit, in_flight))
+    else:
+        run(lambda: purge(tube, command.split('-')[1], limit))
+
+
+TOP_COLUMNS = ['server', 'tube', 'ready', 'reserved', 'delayed', 'buried',
+        'put/s', 'delete/s', 'watching', 'waiting']
+
+
+def parse_server(server):
+    # a (host, port) tuple from a "host[:port]" or "unix:path" string
+    if server.startswith('unix:'):
+        return server, None
+    host, _, port = server.partition(':')
+    return host or 'localhost', int(port or 11300)
+
+
+@coroutine
+def sample(server, tubes):
+    # sample stats and tube stats in a single round trip; the list of tubes is
+    # fetched first, when the tubes are not given
+    if not tubes:
+        tubes = yield server.list_tubes()
+        if isinstance(tubes, Exception):
+            raise tubes
+    results = yield [server.stats()] + [server.stats_tube(t) for t in tubes]
+    if isinstance(results[0], Exception):
+        raise results[0]
+    raise Return((time.time(), results[0], dict((stats['name'], stats)
+            for stats in results[1:] if not isinstance(stats, Exception))))
+
+
+def rate(stats, previous, seconds, key):
+    # the rate per second of a cumulative counter in two samples of stats
+    if not previous or key not in previous:
+        return 0.0
+    return max(stats[key] - previous[key], 0) / max(seconds, 1e-6)
+
+
+def top_rows(name, now, then):
+    # rows of the top view, for the tubes in a sample of a server
+    rows = []
+    for tube, stats in now[2].items():
+        previous = then and then[2].get(tube)
+        seconds = then and now[0] - then[0]
+        rows.append({'server': name, 'tube': tube,
+            'ready': stats['current-jobs-ready'],
+            'reserved': stats['current-jobs-reserved'],
+            'delayed': stats['current-jobs-delayed'],
+            'buried': stats['current-jobs-buried'],
+            'put/s': rate(stats, previous, seconds, 'total-jobs'),
+            'delete/s': rate(stats, previous, seconds, 'cmd-delete'),
+            'watching': stats['current-watching'],
+            'waiting': stats['current-waiting']})
+    return rows
+
+
+def format_cell(value):
+    return '{:.1f}'.format(value) if isinstance(value, float) else str(value)
+
+
+def format_row(row, widths):
+    # the server and tube names are left aligned, numbers right aligned
+    cells = []
+    for column, width in zip(TOP_COLUMNS, widths):
+        if column in ('server', 'tube'):
+            cells.append(format_cell(row[column]).ljust(width))
+        else:
+            cells.append(format_cell(row[column]).rjust(width))
+    return '  '.join(cells)
+
+
+@coroutine
+def monitor(servers, interval, sort, tubes, iterations):
+    clients = []
+    for server in servers:
+        host, port = parse_server(server)
+        clients.append(beanstalkt.Client(host, port))
+        yield clients[-1].connect()
+    samples = [None] * len(clients)
+    count = 0
+    while iterations is None or count < iterations:
+        count += 1
+        started = time.time()
+        previous = samples
+        samples = yield [sample(c, tubes) for c in clients]
+        lines = ['beanstalkt top - {}, every {}s, sorted by {}'.format(
+                time.strftime('%H:%M:%S'), interval, sort), '']
+        rows = []
+        for server, now, then in zip(servers, samples, previous):
+            stats = now[1]
+            args = (stats, then and then[1], then and now[0] - then[0])
+            lines.append('{}: {} connections, {} producers, {} workers, '
+                    '{} waiting, {:.1f} put/s, {:.1f} reserve/s, '
+                    '{:.1f} delete/s'.format(server,
+                    stats['current-connections'], stats['current-producers'],
+                    stats['current-workers'], stats['current-waiting'],
+                    rate(*args + ('cmd-put',)),
+                    rate(*args + ('cmd-reserve',)),
+                    rate(*args + ('cmd-delete',))))
+            rows += top_rows(server, now, then)
+        rows.sort(key=lambda row: row[sort],
+                reverse=sort not in ('server', 'tube'))
+        header = dict((c, c.upper()) for c in TOP_COLUMNS)
+        widths = [max(len(format_cell(row[c])) for row in [header] + rows)
+                for c in TOP_COLUMNS]
+        lines.append('')
+        lines += [format_row(row, widths) for row in [header] + rows]
+        if sys.stdout.isatty():
+            # clear the screen
+            sys.stdout.write('\x1b[H\x1b[2J')
+        sys.stdout.write('\n'.join(lines) + '\n\n')
+        sys.stdout.flush()
+        if iterations is None or count < iterations:
+            yield Task(ioloop.add_timeout, started + interval)
+    for c in clients:
+        yield c.close()
+
+
+def top(servers, interval, sort, tube, iterations, func):
+    def done(future):
+        try:
+            future.result()
+        except Exception as e:
+            print(e)
+        ioloop.stop()
+    ioloop.add_future(monitor(servers, interval, sort, tube, iterations),
+            done)
+    ioloop.start()
 
 
-def put(body, priority, use, delay, ttr, func):
+def bench(producers, consumers, connections, body_size, tubes,
+          priority_range, delay, delayed, duration, in_flight, as_json,
+          tcp_nodelay, keepalive, sndbuf, rcvbuf, read_chunk_size, func):
+    from beanstalkt.bench import Bench, format_report
+    benchmark = Bench(client.host, client.port, producers=producers,
+            consumers=consumers, connections=connections,
+            body_size=body_size, tubes=tubes,
+            priority_range=[int(p) for p in priority_range.split(':')],
+            delayed=delayed, delay=delay, duration=duration,
+            in_flight=in_flight, io_loop=ioloop, client_options=dict(
+            tcp_nodelay=tcp_nodelay, tcp_keepalive=keepalive, sndbuf=sndbuf,
+            rcvbuf=rcvbuf, read_chunk_size=read_chunk_size))
+    def done(future):
+        try:
+            report = future.result()
+        except Exception as e:
+            print(e)
+        else:
+            if as_json:
+                print(json.dumps(report, indent=2))
+            else:
+                print(format_report(report))
+        ioloop.stop()
+    ioloop.add_future(benchmark.run(), done)
+    ioloop.start()
+
+
+class SessionParser(argparse.ArgumentParser):
+    # report errors in a session line, instead of exiting
+    def error(self, message):
+        raise ValueError(message)
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or 'help is not available in a session')
+
+    def print_help(self, file=None):
+        pass
+
+
+@coroutine
+def session_command(args):
+    # run the command of a parsed session line, and return the result
+    func = args.func
+    requests = []
+    if (func in (put, peek_ready, peek_delayed, peek_buried, kick) and
+            client._using != args.use):
+        requests.append(client.use(args.use))
+    if func is put:
+        if args.body is None:
+            raise ValueError('put: give a body (putting jobs from a file is '
+                    'not available in a session)')
+        requests.append(client.put(args.body.encode('utf8'),
+                priority=args.priority, delay=args.delay, ttr=args.ttr))
+    elif func is reserve:
+        requests += [client.watch(tube) for tube in args.watch or []]
+        if args.ignore_default:
+            requests.append(client.ignore('default'))
+        requests.append(client.reserve(args.timeout))
+    elif func is peek:
+        requests.append(client.peek(args.job_id))
+    elif func in (peek_ready, peek_delayed, peek_buried):
+        requests.append(getattr(client, func.__name__)())
+    elif func is kick:
+        requests.append(client.kick(args.bound))
+    elif func is kick_job:
+        requests.append(client.kick_job(args.job_id))
+    elif func is stats_job:
+        requests.append(client.stats_job(args.job_id))
+    elif func is stats_tube:
+        requests.append(client.stats_tube(args.name))
+    elif func is stats:
+        requests.append(client.stats())
+    elif func is list_tubes:
+        requests.append(client.list_tubes())
+    elif func is pause_tube:
+        requests.append(client.pause_tube(args.name, args.delay))
+    else:
+        raise ValueError('command is not available in a session')
+    results = yield requests
+    result = results[-1]
+    if func is reserve and not isinstance(result, Exception):
+        # act on the job, even if watching a tube failed
+        if args.action == 'delete':
+            done = yield client.delete(result.id)
+        elif args.action == 'release':
+            done = yield client.release(result.id, args.priority, args.delay)
+        else:
+            done = yield client.bury(result.id, args.priority)
+        results.append(done)
+    for r in results:
+        if isinstance(r, Exception):
+            raise r
+    if isinstance(result, dict) and 'body' in result:
+        result['body'] = result['body'].decode('utf8', 'replace')
+    raise Return(result)
+
+
+def parse_session_line(parser, line):
+    # the parsed arguments of a session line, or the error parsing it
+    try:
+        return parser.parse_args(shlex.split(line))
+    except ValueError as e:
+        return e
+
+
+@coroutine
+def session_line(args):
+    if isinstance(args, Exception):
+        raise args
+    result = yield session_command(args)
+    raise Return(result)
+
+
+@coroutine
+def session_output(number, line, future):
+    # print the result of a session line as JSON, returns False on error
+    record = dict(line=number, command=line)
+    try:
+        record['result'] = yield future
+    except Exception as e:
+        record['error'] = '{}: {}'.format(e.__class__.__name__,
+                getattr(e, 'status', e))
+    print(json.dumps(record))
+    sys.stdout.flush()
+    raise Return('error' not in record)
+
+
+@coroutine
+def run_session(source, pipeline, keep_going):
+    # run the commands read from the source, keeping up to `pipeline`
+    # commands waiting for a reply, and output the results in order
+    parser = make_parser(SessionParser)
+    pending = deque()
+    stopped = False
+    for number, line in enumerate(source, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        args = parse_session_line(parser, line)
+        pending.append((number, line, session_line(args)))
+        # a reserve acts on the job only when it has been reserved, so the
+        # lines after it are not sent until it is done
+        if getattr(args, 'func', None) is reserve:
+            waiting = 0
+        else:
+            waiting = pipeline - 1
+        while len(pending) > waiting and not stopped:
+            ok = yield session_output(*pending.popleft())
+            stopped = not ok and not keep_going
+        if stopped:
+            break
+    # the commands already sent are run, also when stopping at an error
+    while pending:
+        yield session_output(*pending.popleft())
+
+
+def session(file, pipeline, keep_going, func):
+    pipeline = max(pipeline, 1)
+    if file == '-':
+        run(lambda: run_session(sys.stdin, pipeline, keep_going))
+        return
+    with open(file) as source:
+        run(lambda: run_session(source, pipeline, keep_going))
+
+
+def bench_sync(threads, connections, body_size, duration, as_json, func):
+    from beanstalkt.bench import sync_bench, format_sync_report
+    report = sync_bench(client.host, client.port, threads=threads,
+            connections=connections, body_size=body_size, duration=duration)
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_sync_report(report))
+
+
+@coroutine
+def inspect_jobs(tubes, id_range, concurrency, rate, bodies, as_json):
+    from beanstalkt.inspector import Inspector, format_report
+    progress = Progress('job ids checked')
+    inspector = Inspector(client, concurrency=concurrency, rate=rate,
+            bodies=bodies, tubes=tubes if id_range else None,
+            on_job=lambda job_id, stats: progress.add(1, isinstance(stats,
+            Exception) and not isinstance(stats, beanstalkt.CommandFailed)))
+    if id_range:
+        first, last = [int(i) for i in id_range.split(':')]
+        yield inspector.inspect_range(first, last)
+    else:
+        if not tubes:
+            tubes = yield client.list_tubes()
+        yield inspector.inspect_tubes(tubes)
+    progress.done()
+    report = inspector.report()
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+
+
+def inspect(tube, range, concurrency, rate, bodies, as_json, func):
+    run(lambda: inspect_jobs(tube, range, concurrency, rate, bodies, as_json))
+
+
+def replay(file, speed, in_flight, reserve_timeout, as_json, func):
+    from beanstalkt.recorder import Replayer, format_report
+    replayer = Replayer(file, client.host, client.port, speed=speed,
+            in_flight=in_flight, reserve_timeout=reserve_timeout,
+            io_loop=ioloop)
+    def done(future):
+        try:
+            report = future.result()
+        except Exception as e:
+            print(e)
+        else:
+            if as_json:
+                print(json.dumps(report, indent=2))
+            else:
+                print(format_report(report))
+        ioloop.stop()
+    ioloop.add_future(replayer.run(), done)
+    ioloop.start()
+
+
+def put(body, priority, use, delay, ttr, from_file, stdin, format, in_flight,
+        failed, func):
+    if body is None:
+        if stdin:
+            source = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            source = open(from_file, 'rb')
+        run(lambda: bulk_put(source, format, priority, use, delay, ttr,
+                in_flight, failed))
+        return
     def step1(_):
         client.put(body.encode('utf8'), priority=priority, delay=delay, ttr=ttr,
                 callback=success(step2))
     def step2(data):
         print(data)
-    start(lambda: client.use(use, step1))
+    start(lambda: client.use(use, callback=step1))
 
 
 def reserve(action, timeout, watch, ignore_default, priority, delay, func):
 
     def step1(_=None):
         if watch:
-            client.watch(watch.pop(), step1)
+            client.watch(watch.pop(), callback=step1)
         elif ignore_default:
-            client.ignore('default', step2)
+            client.ignore('default', callback=step2)
         else:
             step2()
 
     def step2(_=None):
-        client.reserve(timeout, success(step3, last=False))
+        client.reserve(timeout, callback=success(step3, last=False))
 
     def step3(data):
         data['body'] = data['body'].decode('utf8')
@@ -184,11 +931,11 @@ def reserve(action, timeout, watch, ignore_default, priority, delay, func):
 
         cb = success(lambda _: None)
         if action == 'delete':
-            client.delete(data['id'], cb)
+            client.delete(data['id'], callback=cb)
         elif action == 'release':
-            client.release(data['id'], priority, delay, cb)
+            client.release(data['id'], priority, delay, callback=cb)
         elif action == 'bury':
-            client.bury(data['id'], priority, cb)
+            client.bury(data['id'], priority, callback=cb)
 
     start(step1)
 
@@ -197,74 +944,76 @@ def peek(job_id, func):
     def step2(data):
         data['body'] = data['body'].decode('utf8')
         print(json.dumps(data, indent=2))
-    start(lambda: client.peek(job_id, success(step2)))
+    start(lambda: client.peek(job_id, callback=success(step2)))
 
 
 def peek_ready(use, func):
     def step1(_):
-        client.peek_ready(success(step2))
+        client.peek_ready(callback=success(step2))
     def step2(data):
         data['body'] = data['body'].decode('utf8')
         print(json.dumps(data, indent=2))
-    start(lambda: client.use(use, step1))
+    start(lambda: client.use(use, callback=step1))
 
 
 def peek_delayed(use, func):
     def step1(_):
-        client.peek_delayed(success(step2))
+        client.peek_delayed(callback=success(step2))
     def step2(data):
         data['body'] = data['body'].decode('utf8')
         print(json.dumps(data, indent=2))
-    start(lambda: client.use(use, step1))
+    start(lambda: client.use(use, callback=step1))
 
 
 def peek_buried(use, func):
     def step1(_):
-        client.peek_buried(success(step2))
+        client.peek_buried(callback=success(step2))
     def step2(data):
         data['body'] = data['body'].decode('utf8')
         print(json.dumps(data, indent=2))
-    start(lambda: client.use(use, step1))
+    start(lambda: client.use(use, callback=step1))
 
 
 def kick(bound, use, func):
     def step1(_):
-        client.kick(bound, success(step2))
+        client.kick(bound, callback=success(step2))
     def step2(data):
         print(data)
-    start(lambda: client.use(use, step1))
+    start(lambda: client.use(use, callback=step1))
 
 
 def kick_job(job_id, func):
-    start(lambda: client.kick_job(job_id, success(lambda _: None)))
+    start(lambda: client.kick_job(job_id,
+            callback=success(lambda _: None)))
 
 
 def stats_job(job_id, func):
     def step2(data):
         print(json.dumps(data, indent=2))
-    start(lambda: client.stats_job(job_id, success(step2)))
+    start(lambda: client.stats_job(job_id, callback=success(step2)))
 
 
 def stats_tube(name, func):
     def step2(data):
         print(json.dumps(data, indent=2))
-    start(lambda: client.stats_tube(name, success(step2)))
+    start(lambda: client.stats_tube(name, callback=success(step2)))
 
 
 def stats(func):
     def step2(data):
         print(json.dumps(data, indent=2))
-    start(lambda: client.stats(success(step2)))
+    start(lambda: client.stats(callback=success(step2)))
 
 
 def list_tubes(func):
     def step2(data):
         print(json.dumps(data, indent=2))
-    start(lambda: client.list_tubes(success(step2)))
+    start(lambda: client.list_tubes(callback=success(step2)))
 
 
 def pause_tube(name, delay, func):
-    start(lambda: client.pause_tube(name, delay, success(lambda _: None)))
+    start(lambda: client.pause_tube(name, delay,
+            callback=success(lambda _: None)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+"""beanstalkt.envelope - Tracing of jobs from put, through reserve, to delete
+
+A client with a tracer wraps the body of each job put in a small envelope,
+stamping the job with the time it was put, a trace id and the tube name. The
+envelope is stripped off again, when the job is reserved or peeked by a client
+with a tracer. The tracer records the time jobs waited in the queue, and the
+end-to-end latency from put to delete, in histograms per tube.
+
+The envelope is 22 bytes plus the length of the tube name: a 4 byte magic
+and a version byte, followed by the put time, the trace id and the tube name
+with its length. Jobs without a valid envelope are passed through untouched.
+"""
+
+import random
+import struct
+import time
+
+from tornado.util import ObjectDict
+
+from .histogram import Histogram
+
+
+MAGIC = b'\xbeBTE'
+VERSION = 1
+# magic, version, put time, trace id, tube length
+HEADER = struct.Struct('!4sBdQB')
+
+
+class Tracer(object):
+    """Wraps and unwraps job bodies in envelopes, and records histograms of
+    the queue wait time (put to reserve) and end-to-end latency (put to
+    delete) in seconds, per tube.
+
+    If given, on_span is called with a dict describing each job that is
+    deleted, released or buried after being reserved by the client, for
+    forwarding to an external tracer. The dict has the keys job_id, tube,
+    trace_id, put_at, reserved_at, finished_at and outcome ('deleted',
+    'released' or 'buried').
+    """
+
+    def __init__(self, on_span=None):
+        self.on_span = on_span
+        self.queue_wait = {}  # tube -> histogram
+        self.latency = {}  # tube -> histogram
+        self._spans = {}  # id of reserved job -> span
+
+    def wrap(self, body, tube, trace_id=None):
+        """Returns the body wrapped in an envelope."""
+        if trace_id is None:
+            trace_id = random.getrandbits(64)
+        name = tube.encode('utf8')
+        header = HEADER.pack(MAGIC, VERSION, time.time(), trace_id,
+                len(name))
+        return header + name + body
+
+    def unwrap(self, job, reserved=False):
+        """Strip the envelope off the body of the job (a dict with keys id
+        and body), and add the keys trace_id and put_at to the job. A body
+        without a valid envelope is left as is.
+
+        For a reserved job, the queue wait time is recorded, and the job is
+        traced until it is deleted, released or buried.
+        """
+        body = job['body']
+        if len(body) < HEADER.size or body[:len(MAGIC)] != MAGIC:
+            return
+        magic, version, put_at, trace_id, length = HEADER.unpack_from(body)
+        if version != VERSION or len(body) < HEADER.size + length:
+            return
+        name = body[HEADER.size:HEADER.size + length]
+        try:
+            tube = memoryview(name).tobytes().decode('utf8')
+        except UnicodeDecodeError:
+            return
+        job['body'] = body[HEADER.size + length:]
+        job['trace_id'] = trace_id
+        job['put_at'] = put_at
+        if reserved:
+            now = time.time()
+            self._histogram(self.queue_wait, tube).add(now - put_at)
+            self._spans[job['id']] = ObjectDict(job_id=job['id'], tube=tube,
+                    trace_id=trace_id, put_at=put_at, reserved_at=now)
+
+    def finished(self, job_id, outcome):
+        """End the trace of a reserved job, with the outcome 'deleted',
+        'released' or 'buried'.
+        """
+        span = self._spans.pop(job_id, None)
+        if span is None:
+            return
+        span.finished_at = time.time()
+        span.outcome = outcome
+        if outcome == 'deleted':
+            self._histogram(self.latency, span.tube).add(
+                    span.finished_at - span.put_at)
+        if self.on_span:
+            self.on_span(span)
+
+    def _histogram(self, histograms, tube):
+        if tube not in histograms:
+            histograms[tube] = Histogram()
+        return histograms[tube]
@@ -0,0 +1,157 @@
+"""beanstalkt.fair - Weighted fair reserving from several tubes
+
+When reserving from several watched tubes, beanstalkd picks the job with the
+highest priority, and a busy tube can starve the other tubes. The fair
+reserver gives each tube a share of the reserved jobs in proportion to its
+weight, using stride scheduling: the tube with the lowest pass value is
+probed first, with a reserve-with-timeout 0 while watching only that tube,
+and the pass value of a tube grows by 1/weight for each job reserved from it.
+
+Each probe is a round trip, with the watch and ignore commands changing the
+watch list written together with the reserve. The number of probes per job
+is bounded, and tubes found empty are not probed again for a while. When
+the probes find no job, a reserve with a timeout is sent while watching all
+the tubes, followed by a stats-job command to find the tube of the job.
+"""
+
+import time
+
+from tornado.gen import coroutine, Return
+from tornado.util import ObjectDict
+
+from .beanstalkt import TimedOut
+
+
+class FairReserver(object):
+    """Reserves jobs from the tubes given in weights (a dict of tube name ->
+    weight), with the client, in proportion to the weights.
+
+    At most `max_probes` tubes are probed for each job. A tube found empty
+    is not probed again for `backoff` seconds. When no job is found by
+    probing, the reserver waits for a job from any of the tubes, with
+    reserves timing out after `wait` seconds.
+
+    The reserver changes the client's watch list, so the client should not
+    be used for reserving otherwise, and reserve() should not be called
+    again before it returns. The watch list is kept by the client, and is
+    restored by the client when it re-connects.
+
+    The counters in `metrics` are the number of jobs reserved, probes sent,
+    probes finding the tube empty, watch and ignore commands sent, waits for
+    a job from any tube, and stats-job lookups.
+    """
+
+    def __init__(self, client, weights, max_probes=3, backoff=0.5, wait=1):
+        self.client = client
+        self.max_probes = max_probes
+        self.backoff = backoff
+        self.wait = wait
+        self._weights = {}
+        self._pass = {}  # tube -> pass value
+        self._empty_until = {}  # tube -> time to probe the tube again
+        self._virtual = 0.0  # pass value of the last tube reserved from
+        for tube, weight in weights.items():
+            self.set_weight(tube, weight)
+        self.metrics = ObjectDict(jobs=0, probes=0, empty_probes=0,
+                watch_changes=0, waits=0, lookups=0)
+
+    def set_weight(self, tube, weight):
+        """Set the weight of a tube. A weight of 0 removes the tube."""
+        if weight <= 0:
+            self._weights.pop(tube, None)
+            self._pass.pop(tube, None)
+            return
+        self._weights[tube] = float(weight)
+        # a new tube starts at the current pass, not getting a head start
+        self._pass.setdefault(tube, self._virtual)
+
+    def round_trips(self):
+        """The average number of round trips per job reserved."""
+        trips = self.metrics.probes + self.metrics.waits + self.metrics.lookups
+        return float(trips) / self.metrics.jobs if self.metrics.jobs else None
+
+    @coroutine
+    def reserve(self, timeout=None):
+        """Reserve a job, with optional timeout in seconds. Returns a job dict
+        with the keys id, body and tube, or an exception like
+        Client.reserve().
+        """
+        assert self._weights, 'no tubes to reserve from'
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            job = yield self._probe()
+            if job is not None:
+                raise Return(job)
+            wait = self.wait
+            if deadline is not None:
+                wait = max(0, min(wait, int(deadline - time.time())))
+            job = yield self._reserve_any(wait)
+            if not isinstance(job, TimedOut):
+                raise Return(job)
+            if deadline is not None and time.time() >= deadline:
+                raise Return(job)
+
+    @coroutine
+    def _probe(self):
+        # probe the tubes with the lowest pass values, which are not backing
+        # off after being found empty
+        now = time.time()
+        tubes = [t for t in self._weights
+                if self._empty_until.get(t, 0) <= now]
+        for tube in tubes:
+            if tube in self._empty_until:
+                # a tube that has been empty gets no credit for the time
+                self._pass[tube] = max(self._pass[tube], self._virtual)
+        tubes.sort(key=lambda t: (self._pass[t], t))
+        for tube in tubes[:self.max_probes]:
+            requests = self._watch_only([tube])
+            requests.append(self.client.reserve(0))
+            results = yield requests
+            self.metrics.probes += 1
+            job = results[-1]
+            if isinstance(job, TimedOut):
+                self.metrics.empty_probes += 1
+                self._empty_until[tube] = time.time() + self.backoff
+                continue
+            if not isinstance(job, Exception):
+                self._reserved(job, tube)
+            raise Return(job)
+
+    @coroutine
+    def _reserve_any(self, wait):
+        # wait for a job from any of the tubes, and look up its tube
+        requests = self._watch_only(self._weights)
+        requests.append(self.client.reserve(wait))
+        results = yield requests
+        self.metrics.waits += 1
+        job = results[-1]
+        if isinstance(job, Exception):
+            raise Return(job)
+        stats = yield self.client.stats_job(job.id)
+        self.metrics.lookups += 1
+        tube = None if isinstance(stats, Exception) else stats['tube']
+        if tube in self._weights:
+            self._reserved(job, tube)
+        else:
+            job['tube'] = tube
+            self.metrics.jobs += 1
+        raise Return(job)
+
+    def _watch_only(self, tubes):
+        # the watch and ignore commands making the client watch only the
+        # given tubes; the tubes are watched before others are ignored, as
+        # the last tube watched can not be ignored
+        client = self.client
+        tubes = set(tubes)
+        ignore = client._watching - tubes
+        requests = [client.watch(t) for t in tubes - client._watching]
+        requests += [client.ignore(t) for t in ignore]
+        self.metrics.watch_changes += len(requests)
+        return requests
+
+    def _reserved(self, job, tube):
+        job['tube'] = tube
+        self.metrics.jobs += 1
+        self._empty_until.pop(tube, None)
+        self._virtual = max(self._virtual, self._pass[tube])
+        self._pass[tube] = self._virtual + 1 / self._weights[tube]
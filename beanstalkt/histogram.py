@@ -0,0 +1,76 @@
+"""beanstalkt.histogram - A compact histogram for latencies and sizes"""
+
+import math
+
+
+class Histogram(object):
+    """A histogram of non-negative values, counted in logarithmic buckets.
+
+    With the default precision of 8 buckets per doubling of the value, the
+    percentiles are within about 5% of the actual values.
+    """
+
+    def __init__(self, precision=8):
+        self.precision = precision
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._buckets = {}  # bucket index -> count
+
+    def add(self, value):
+        """Add a value to the histogram."""
+        if value > 0:
+            index = int(math.floor(math.log(value, 2) * self.precision))
+        else:
+            index = None
+        self._buckets[index] = self._buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values counted in another histogram to this histogram."""
+        assert other.precision == self.precision
+        for index, count in other._buckets.items():
+            self._buckets[index] = self._buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self):
+        """The mean of the values, or None if the histogram is empty."""
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """The p'th percentile (0-100) of the values, or None if the
+        histogram is empty.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index in sorted(self._buckets, key=lambda i: -1e300 if i is None
+                else i):
+            seen += self._buckets[index]
+            if seen >= rank:
+                break
+        if index is None:
+            return 0
+        # the middle of the bucket, within the range of the values seen
+        value = 2 ** ((index + 0.5) / self.precision)
+        return min(max(value, self.min), self.max)
+
+    def summary(self):
+        """A dict with count, mean, min, max and the 50th, 90th and 99th
+        percentiles of the values.
+        """
+        return dict(count=self.count, mean=self.mean(), min=self.min,
+                max=self.max, p50=self.percentile(50),
+                p90=self.percentile(90), p99=self.percentile(99))
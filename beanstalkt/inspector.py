@@ -0,0 +1,148 @@
+"""beanstalkt.inspector - Distributions of the age and size of jobs
+
+The server only reports the stats of a single job at a time. The inspector
+walks a range of job ids, or the jobs at the peek points of tubes (the next
+ready, delayed and buried job), with pipelined stats-job and peek commands,
+and builds histograms of the age, time-to-run, number of releases and body
+size of the jobs, per tube and state.
+
+The number of jobs being inspected at a time, and the rate of jobs
+inspected, can be capped to limit the load put on the server.
+"""
+
+from collections import deque
+
+from tornado.gen import coroutine
+from tornado.util import ObjectDict
+
+from .beanstalkt import CommandFailed
+from .histogram import Histogram
+from .ratelimit import TokenBucket
+
+
+class Inspector(object):
+    """Inspects jobs with the client, keeping at most `concurrency` jobs
+    being inspected at a time, and inspecting at most `rate` jobs per second
+    (default is no limit).
+
+    If bodies is True, each job is also peeked at, to get the size of the
+    body; this transfers the body from the server. If tubes are given, only
+    the jobs in these tubes are counted (and peeked at).
+
+    If given, on_job is called with the job id and the stats of the job, or
+    an exception if the job was not found or the stats failed.
+    """
+
+    def __init__(self, client, concurrency=10, rate=None, bodies=True,
+                 tubes=None, on_job=None):
+        self.client = client
+        self.concurrency = max(concurrency, 1)
+        self.bodies = bodies
+        self.tubes = set(tubes) if tubes else None
+        self.on_job = on_job
+        self.histograms = {}  # (tube, state) -> histograms
+        self.inspected = 0
+        self.missing = 0
+        self.errors = 0
+        self._bucket = TokenBucket(rate) if rate else None
+
+    @coroutine
+    def inspect_range(self, first, last):
+        """Inspect the jobs with ids from first to last (both included)."""
+        yield self.inspect_ids(range(first, last + 1))
+
+    @coroutine
+    def inspect_tubes(self, tubes):
+        """Inspect the jobs at the peek points (the next ready, delayed and
+        buried job) of the tubes.
+        """
+        client = self.client
+        previous = client._using
+        ids = set()
+        for tube in tubes:
+            results = yield [client.use(tube), client.peek_ready(),
+                    client.peek_delayed(), client.peek_buried()]
+            ids.update(job.id for job in results[1:]
+                    if not isinstance(job, Exception))
+        if client._using != previous:
+            yield client.use(previous)
+        yield self.inspect_ids(sorted(ids))
+
+    @coroutine
+    def inspect_ids(self, ids):
+        """Inspect the jobs with the given ids."""
+        pending = deque()
+        for job_id in ids:
+            if self._bucket:
+                yield self._bucket.acquire(self.client.io_loop)
+            pending.append(self._inspect(job_id))
+            if len(pending) >= self.concurrency:
+                yield pending.popleft()
+        yield list(pending)
+
+    @coroutine
+    def _inspect(self, job_id):
+        # get the stats of the job, and peek at the job together with the
+        # stats, unless the tube of the job must be checked first
+        requests = [self.client.stats_job(job_id)]
+        if self.bodies and not self.tubes:
+            requests.append(self.client.peek(job_id))
+        results = yield requests
+        stats = results[0]
+        if self.on_job:
+            self.on_job(job_id, stats)
+        if isinstance(stats, CommandFailed):
+            self.missing += 1
+            return
+        elif isinstance(stats, Exception):
+            self.errors += 1
+            return
+        if self.tubes and stats['tube'] not in self.tubes:
+            return
+        if self.bodies and self.tubes:
+            results.append((yield self.client.peek(job_id)))
+        self.inspected += 1
+        key = (stats['tube'], stats['state'])
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = ObjectDict(age=Histogram(),
+                    ttr=Histogram(), releases=Histogram(), size=Histogram())
+        h.age.add(stats['age'])
+        h.ttr.add(stats['ttr'])
+        h.releases.add(stats['releases'])
+        job = results[-1] if self.bodies else None
+        if job is not None and not isinstance(job, Exception):
+            h.size.add(len(job['body']))
+
+    def report(self):
+        """The report of the jobs inspected (a dict), with a dict of summaries
+        of the histograms for each tube and state.
+        """
+        tubes = {}
+        for (tube, state), h in self.histograms.items():
+            tubes.setdefault(tube, {})[state] = dict(count=h.age.count,
+                    age=h.age.summary(), ttr=h.ttr.summary(),
+                    releases=h.releases.summary(), size=h.size.summary())
+        return dict(inspected=self.inspected, missing=self.missing,
+                errors=self.errors, tubes=tubes)
+
+
+def format_report(report):
+    """Format the report as text."""
+    lines = ['{inspected} jobs inspected, {missing} not found, {errors} '
+            'errors'.format(**report)]
+    if not report['tubes']:
+        return lines[0]
+    row = '{:<20} {:<8} {:>7} {:>17} {:>9} {:>9} {:>17}'
+    lines.append(row.format('tube', 'state', 'jobs', 'age p50/p99/max s',
+            'ttr p50', 'rel. max', 'size p50/p99/max'))
+    for tube, states in sorted(report['tubes'].items()):
+        for state, s in sorted(states.items()):
+            size = '-'
+            if s['size']['count']:
+                size = '{p50:.0f}/{p99:.0f}/{max:.0f}'.format(**s['size'])
+            lines.append(row.format(tube, state, s['count'],
+                    '{p50:.0f}/{p99:.0f}/{max:.0f}'.format(**s['age']),
+                    '{:.0f}'.format(s['ttr']['p50']),
+                    s['releases']['max'], size))
+    return '\n'.join(lines)
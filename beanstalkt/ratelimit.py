@@ -0,0 +1,75 @@
+"""beanstalkt.ratelimit - Token buckets for client side rate limiting"""
+
+import time
+
+from collections import deque
+
+from tornado.concurrent import Future
+
+
+class TokenBucket(object):
+    """A token bucket refilled with `rate` tokens per second, holding at most
+    `burst` tokens (default is one second worth of tokens, min. 1 token).
+
+    Tokens are handed out in FIFO order. Waiting for a token does not block,
+    the waiters are woken by a timeout on the IOLoop.
+
+    A bucket is not thread-safe, and must only be used on a single IOLoop.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, self.rate)
+        self._tokens = self.burst
+        self._stamp = time.time()
+        self._waiters = deque()
+        self._timeout = None
+
+    def acquire(self, io_loop):
+        """Take a token from the bucket. Returns a future, which is resolved
+        when the token has been taken.
+        """
+        future = Future()
+        self._waiters.append(future)
+        self._wake(io_loop)
+        return future
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst,
+                self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def _wake(self, io_loop):
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            self._waiters.popleft().set_result(None)
+        if self._waiters and self._timeout is None:
+            # wake again, when the next token is available
+            wait = (1 - self._tokens) / self.rate
+            self._timeout = io_loop.add_timeout(time.time() + wait,
+                    lambda: self._on_timeout(io_loop))
+
+    def _on_timeout(self, io_loop):
+        self._timeout = None
+        self._wake(io_loop)
+
+
+_shared_buckets = {}  # (command, tube) -> token bucket shared by clients
+
+
+def shared_bucket(command, tube, rate, burst=None):
+    """Returns the token bucket for the command and tube, which is shared by
+    all clients in the process. The bucket is created with the given rate and
+    burst, or updated if it exists. As the bucket is not thread-safe, the
+    clients sharing it must run on the same IOLoop.
+    """
+    key = (command, tube)
+    bucket = _shared_buckets.get(key)
+    if bucket is None:
+        bucket = _shared_buckets[key] = TokenBucket(rate, burst)
+    else:
+        bucket.rate = float(rate)
+        bucket.burst = burst or max(1, bucket.rate)
+    return bucket
@@ -0,0 +1,273 @@
+"""beanstalkt.recorder - Recording and replaying the traffic of clients
+
+A client with a recorder logs every request it writes, and every response it
+reads, with a timestamp to a binary file. The file starts with the bytes
+MAGIC, followed by a record per request or response: a header (the kind of
+record, the time in seconds since the epoch, the connection number and the
+length of the data) and the data as sent over the wire. A recorder can be
+shared by several clients, each getting its own connection number.
+
+A replayer re-issues the recorded requests against another server, one client
+per recorded connection, either with the original timing (optionally sped up)
+or as fast as possible. Job ids in the recorded commands are mapped to the ids
+of the jobs put and reserved during the replay. Replies differing in status
+from the recorded replies are reported as divergences, along with the
+recorded and replayed latencies per command.
+"""
+
+import math
+import struct
+import time
+import weakref
+
+from tornado.gen import coroutine, Return, Task
+from tornado.ioloop import IOLoop
+from tornado.util import ObjectDict
+
+from .beanstalkt import Client
+from .histogram import Histogram
+
+
+MAGIC = b'BTREC\x01'
+RECORD = struct.Struct('!BdII')  # kind, time, connection, data length
+REQUEST = 1
+RESPONSE = 2
+
+# commands taking a job id as first argument
+JOB_COMMANDS = set([b'delete', b'release', b'bury', b'touch', b'peek',
+        b'kick-job', b'stats-job'])
+# replies carrying the id of a job
+JOB_REPLIES = set(['INSERTED', 'RESERVED', 'FOUND'])
+
+
+class Recorder(object):
+    """Records the requests and responses of clients to a file, given by a
+    path or a file object opened for binary writing.
+
+    The records are buffered, call flush() or close() to write them out.
+    """
+
+    def __init__(self, file):
+        if hasattr(file, 'write'):
+            self._file = file
+        else:
+            self._file = open(file, 'wb')
+        self._file.write(MAGIC)
+        self._connections = weakref.WeakKeyDictionary()  # client -> number
+        self._next = 0
+        self.records = 0
+
+    def request(self, client, data):
+        """Record the request (bytes) written by the client."""
+        self._write(REQUEST, client, data)
+
+    def response(self, client, data):
+        """Record the response (bytes) read by the client."""
+        self._write(RESPONSE, client, data)
+
+    def _write(self, kind, client, data):
+        connection = self._connections.get(client)
+        if connection is None:
+            connection = self._connections[client] = self._next
+            self._next += 1
+        self._file.write(RECORD.pack(kind, time.time(), connection,
+                len(data)) + data)
+        self.records += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_records(file):
+    """Read the records of a recording, given by a path or a file object
+    opened for binary reading. Yields (kind, time, connection, data) tuples.
+    """
+    if not hasattr(file, 'read'):
+        file = open(file, 'rb')
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError('not a recording')
+    while True:
+        header = file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            break
+        kind, at, connection, length = RECORD.unpack(header)
+        data = file.read(length)
+        if len(data) < length:
+            # the recording was cut off
+            break
+        yield kind, at, connection, data
+
+
+def read_exchanges(file):
+    """Pair the requests and responses of a recording. Returns a dict of
+    connection number -> list of exchanges, each a dict with the keys
+    command, args, body, sent, status, reply (the values following the
+    status) and received. A request without a response (recorded last) has
+    status None.
+    """
+    connections = {}
+    waiting = {}  # connection -> index of the exchange waiting for a reply
+    for kind, at, connection, data in read_records(file):
+        exchanges = connections.setdefault(connection, [])
+        line, _, rest = data.partition(b'\r\n')
+        if kind == REQUEST:
+            words = line.split()
+            # a put has a body, which may be empty
+            body = rest[:-2] if words[0] == b'put' else None
+            exchanges.append(ObjectDict(command=words[0], args=words[1:],
+                    body=body, sent=at, status=None, reply=[],
+                    received=None))
+        else:
+            index = waiting.get(connection, 0)
+            if index >= len(exchanges):
+                continue
+            words = line.decode('utf8').split()
+            exchanges[index].update(status=words[0], reply=words[1:],
+                    received=at)
+            waiting[connection] = index + 1
+    return connections
+
+
+class Replayer(object):
+    """Replays a recording against the beanstalkd server at host and port.
+
+    With speed=1 the requests are issued with the original timing, a higher
+    speed compresses the time between requests. With speed=0 the requests
+    are issued as fast as possible, keeping up to `in_flight` requests per
+    connection waiting for a reply.
+
+    A request with a job id waits for the replies to the requests before it
+    on the same connection, so that the id of a job put or reserved by the
+    connection can be mapped to the id of the replayed job. A plain reserve
+    is replayed as a reserve-with-timeout, waiting as long as the recorded
+    reserve (scaled by the speed) plus a second, or `reserve_timeout` seconds
+    when replaying as fast as possible, so that a replay diverging from the
+    recording does not block forever.
+
+    Options for the clients can be given as a dict in client_options.
+    """
+
+    def __init__(self, file, host='localhost', port=11300, speed=1.0,
+                 in_flight=100, reserve_timeout=1, max_divergences=20,
+                 client_options=None, io_loop=None):
+        self.connections = read_exchanges(file)
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.in_flight = in_flight
+        self.reserve_timeout = reserve_timeout
+        self.max_divergences = max_divergences
+        self.client_options = client_options or {}
+        self.io_loop = io_loop or IOLoop.instance()
+        self.job_ids = {}  # recorded job id -> replayed job id
+        self.commands = {}  # command -> counters and latency histograms
+        self.divergences = []
+        self._first = None
+        self._started = None
+
+    @coroutine
+    def run(self):
+        """Run the replay, and return a report (a dict)."""
+        sent = [e.sent for exchanges in self.connections.values()
+                for e in exchanges[:1]]
+        self._first = min(sent) if sent else 0
+        clients = dict((c, Client(self.host, self.port, io_loop=self.io_loop,
+                **self.client_options)) for c in self.connections)
+        yield [c.connect() for c in clients.values()]
+        self._started = time.time()
+        yield [self._replay(clients[c], exchanges)
+                for c, exchanges in self.connections.items()]
+        elapsed = time.time() - self._started
+        yield [c.close() for c in clients.values()]
+        raise Return(self.report(elapsed))
+
+    @coroutine
+    def _replay(self, client, exchanges):
+        pending = []
+        for exchange in exchanges:
+            if self.speed:
+                at = self._started + (exchange.sent - self._first) / self.speed
+                if at > time.time():
+                    yield Task(self.io_loop.add_timeout, at)
+            elif len(pending) >= self.in_flight:
+                yield pending.pop(0)
+            if exchange.command in JOB_COMMANDS and pending:
+                # wait for the ids of the jobs put or reserved before
+                yield pending
+                pending = []
+            pending.append(self._send(client, exchange))
+        yield pending
+
+    @coroutine
+    def _send(self, client, exchange):
+        command, args = exchange.command, list(exchange.args)
+        if command in JOB_COMMANDS and args:
+            job_id = int(args[0])
+            args[0] = str(self.job_ids.get(job_id, job_id)).encode('utf8')
+        elif command == b'reserve':
+            command = b'reserve-with-timeout'
+            if self.speed and exchange.received:
+                wait = (exchange.received - exchange.sent) / self.speed
+                args = [str(int(math.ceil(wait)) + 1).encode('utf8')]
+            else:
+                args = [str(self.reserve_timeout).encode('utf8')]
+        started = time.time()
+        resp = yield client._raw_command(b' '.join([command] + args),
+                exchange.body)
+        latency = time.time() - started
+
+        name = exchange.command.decode('utf8')
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = ObjectDict(count=0, divergent=0,
+                    recorded=Histogram(), replayed=Histogram())
+        stats.count += 1
+        stats.replayed.add(latency)
+        if exchange.received:
+            stats.recorded.add(exchange.received - exchange.sent)
+        if exchange.status is None:
+            return
+        if resp.status != exchange.status:
+            stats.divergent += 1
+            if len(self.divergences) < self.max_divergences:
+                self.divergences.append(dict(command=b' '.join(
+                        [exchange.command] + exchange.args).decode('utf8'),
+                        recorded=exchange.status, replayed=resp.status))
+        elif resp.status in JOB_REPLIES:
+            self.job_ids[int(exchange.reply[0])] = int(resp.values[0])
+
+    def report(self, elapsed):
+        """The report of the replay (a dict)."""
+        commands = dict((name, dict(count=s.count, divergent=s.divergent,
+                recorded=s.recorded.summary(), replayed=s.replayed.summary()))
+                for name, s in self.commands.items())
+        requests = sum(s.count for s in self.commands.values())
+        return dict(elapsed=elapsed, requests=requests,
+                divergent=sum(s.divergent for s in self.commands.values()),
+                rate=requests / elapsed if elapsed else 0,
+                commands=commands, divergences=self.divergences)
+
+
+def format_report(report):
+    """Format the report as text."""
+    lines = ['{elapsed:.1f}s, {requests} requests ({rate:.0f}/s), '
+            '{divergent} divergent replies'.format(**report)]
+    lines.append('{:<14} {:>7} {:>9} {:>20} {:>20}'.format('command', 'count',
+            'divergent', 'recorded p50/p99 ms', 'replayed p50/p99 ms'))
+    for name, c in sorted(report['commands'].items()):
+        latencies = []
+        for summary in (c['recorded'], c['replayed']):
+            if summary['count']:
+                latencies.append('{:.2f}/{:.2f}'.format(
+                        summary['p50'] * 1000, summary['p99'] * 1000))
+            else:
+                latencies.append('-')
+        lines.append('{:<14} {:>7} {:>9} {:>20} {:>20}'.format(name,
+                c['count'], c['divergent'], *latencies))
+    for d in report['divergences']:
+        lines.append('diverged: {command} (recorded {recorded}, replayed '
+                '{replayed})'.format(**d))
+    return '\n'.join(lines)
@@ -0,0 +1,319 @@
+"""beanstalkt.sync - A blocking, thread-safe client
+
+The SyncClient runs a small pool of clients on an IOLoop in a background
+thread. Its methods can be called from any thread, and block until the
+reply has been received. The commands of the calling threads are multiplexed
+over the connections of the pool, so that many threads (e.g. of a WSGI
+server) share a few connections, instead of having a connection each.
+"""
+
+import re
+import threading
+
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado import version as tornado_version
+
+from .beanstalkt import Client, DEFAULT_PRIORITY, DEFAULT_TTR
+
+
+TUBE_NAME = re.compile(r'^[A-Za-z0-9+/;.$_()][A-Za-z0-9+/;.$_()-]{0,199}$')
+
+
+class Timeout(Exception):
+    """Raised when a call to a SyncClient did not complete in time."""
+
+
+class SyncClient(object):
+    """A blocking, thread-safe client, running a pool of `connections`
+    clients on an IOLoop in a background thread. Other keyword arguments are
+    passed on to the clients, e.g. connect_timeout or tcp_keepalive.
+
+    The methods return what the corresponding Client methods call back
+    with; failed commands return the exception (e.g. CommandFailed). If a
+    call does not complete within `timeout` seconds, Timeout is raised.
+
+    The tube used, and the tubes watched, are given with each call, so that
+    the threads sharing a connection do not interfere. A put into a tube is
+    sent together with a use command (when the connection uses another tube),
+    and a reserve together with the watch and ignore commands needed.
+
+    A reserve occupies its connection until a job is reserved (or the reserve
+    times out), so the reserves are spread over the connections, and the
+    other commands are sent on connections without a pending reserve, if
+    any. Reserves without a timeout are kept off one of the connections, so
+    that the other commands are never stuck behind them; hence a client with
+    a single connection only takes reserves with a timeout. As only the
+    connection that reserved a job may release, bury or touch it, these
+    commands, and delete, are sent on that connection.
+    """
+
+    def __init__(self, host='localhost', port=11300, connections=2,
+                 timeout=10, **options):
+        self.timeout = timeout
+        if tornado_version >= '4.2':
+            self.io_loop = IOLoop(make_current=False)
+        else:
+            self.io_loop = IOLoop()
+        self._clients = [Client(host, port, io_loop=self.io_loop, **options)
+                for _ in range(connections)]
+        # the following are only accessed on the IOLoop thread
+        self._reserving = [0] * connections  # pending reserves
+        self._untimed = [0] * connections  # pending reserves without timeout
+        self._owners = {}  # id of reserved job -> index of connection
+        self._next = 0
+        self._thread = threading.Thread(target=self._run,
+                name='beanstalkt-sync')
+        self._thread.daemon = True
+        self._thread.start()
+        self._call(None, self._connect)
+
+    def _run(self):
+        self.io_loop.make_current()
+        try:
+            self.io_loop.start()
+        finally:
+            self.io_loop.close()
+
+    @coroutine
+    def _connect(self):
+        yield [c.connect() for c in self._clients]
+
+    def close(self):
+        """Close the connections, and stop the IOLoop thread."""
+        try:
+            self._call(None, self._close)
+        finally:
+            self.io_loop.add_callback(self.io_loop.stop)
+            self._thread.join()
+
+    @coroutine
+    def _close(self):
+        yield [c.close() for c in self._clients]
+
+    def _call(self, timeout, func, *args):
+        # run the coroutine function on the IOLoop thread, and wait for the
+        # result, at most timeout seconds (default is the client's timeout)
+        return self._wait(self.timeout if timeout is None else timeout, func,
+                args)
+
+    def _wait(self, timeout, func, args, abandoned=None):
+        # wait for the result of func (forever, if timeout is None); on
+        # timeout, the future of func is passed to abandoned, if given
+        done = threading.Event()
+        futures = []
+        def run():
+            future = func(*args)
+            futures.append(future)
+            self.io_loop.add_future(future, lambda _: done.set())
+        self.io_loop.add_callback(run)
+        if not done.wait(timeout):
+            if abandoned:
+                # called after run(), so the future exists
+                self.io_loop.add_callback(lambda: abandoned(futures[0]))
+            raise Timeout('no reply within {} seconds'.format(timeout))
+        return futures[0].result()
+
+    def _pick(self):
+        # a connection without a pending reserve, taken in turn, if any, or
+        # else one without a pending reserve that has no timeout
+        n = len(self._clients)
+        for pending in (self._reserving, self._untimed):
+            for k in range(n):
+                index = (self._next + k) % n
+                if not pending[index]:
+                    self._next = index + 1
+                    return index
+        self._next += 1
+        return self._next % n
+
+    def _check_tube(self, name):
+        # an invalid name would make the use or watch fail, after the
+        # command following it was sent
+        if not TUBE_NAME.match(name):
+            raise ValueError('invalid tube name: {!r}'.format(name))
+
+    #
+    #  Producer commands
+    #
+
+    def put(self, body, priority=DEFAULT_PRIORITY, delay=0, ttr=DEFAULT_TTR,
+            tube='default', timeout=None):
+        """Put a job body (a byte string) into the tube. Returns the job id.
+        """
+        self._check_tube(tube)
+        return self._call(timeout, self._put, body, priority, delay, ttr,
+                tube)
+
+    @coroutine
+    def _put(self, body, priority, delay, ttr, tube):
+        client = self._clients[self._pick()]
+        results = yield self._using(client, tube) + [client.put(body,
+                priority=priority, delay=delay, ttr=ttr)]
+        raise Return(self._result(results))
+
+    def _using(self, client, tube):
+        # the use command to send before a command for the tube, if needed
+        return [client.use(tube)] if client._using != tube else []
+
+    def _result(self, results):
+        # the first error of the commands sent together, or the last result
+        for result in results:
+            if isinstance(result, Exception):
+                return result
+        return results[-1]
+
+    #
+    #  Worker commands
+    #
+
+    def reserve(self, timeout=None, tubes=('default',)):
+        """Reserve a job from the given tubes, with optional timeout in
+        seconds. Returns a job dict (keys id and body), or an exception
+        (e.g. TimedOut). Without a timeout, the call waits until a job is
+        reserved; this needs a client with more than one connection.
+        """
+        for tube in tubes:
+            self._check_tube(tube)
+        if timeout is None and len(self._clients) == 1:
+            raise ValueError('a reserve without timeout needs more than one '
+                    'connection')
+        wait = timeout + self.timeout if timeout is not None else None
+        return self._wait(wait, self._reserve, (timeout, set(tubes)),
+                self._abandoned_reserve)
+
+    def _pick_reserving(self, timeout):
+        # the connection with the fewest pending reserves; reserves without
+        # timeout are spread over all but one of the connections
+        indexes = range(len(self._clients))
+        if timeout is None:
+            untimed = [i for i in indexes if self._untimed[i]]
+            if len(untimed) < len(self._clients) - 1:
+                untimed = [i for i in indexes if not self._untimed[i]]
+            indexes = untimed
+        return min(indexes, key=lambda i: self._reserving[i])
+
+    @coroutine
+    def _reserve(self, timeout, tubes):
+        index = self._pick_reserving(timeout)
+        client = self._clients[index]
+        untimed = 1 if timeout is None else 0
+        self._reserving[index] += 1
+        self._untimed[index] += untimed
+        try:
+            job = yield client.reserve(timeout, tubes=tubes)
+        finally:
+            self._reserving[index] -= 1
+            self._untimed[index] -= untimed
+        if not isinstance(job, Exception):
+            self._owners[job.id] = index
+        raise Return(job)
+
+    @coroutine
+    def _abandoned_reserve(self, future):
+        # release a job reserved after the caller gave up waiting for it
+        yield future
+        job = future.result()
+        if isinstance(job, Exception):
+            return
+        index = self._owners.pop(job.id)
+        stats = yield self._clients[index].stats_job(job.id)
+        priority = DEFAULT_PRIORITY
+        if not isinstance(stats, Exception):
+            priority = stats['pri']
+        yield self._clients[index].release(job.id, priority)
+
+    def delete(self, job_id, timeout=None):
+        """Delete the job with given id."""
+        return self._call(timeout, self._job_command, 'delete', job_id, True)
+
+    def release(self, job_id, priority=DEFAULT_PRIORITY, delay=0,
+                timeout=None):
+        """Release a reserved job back into the ready queue."""
+        return self._call(timeout, self._job_command, 'release', job_id, True,
+                priority, delay)
+
+    def bury(self, job_id, priority=DEFAULT_PRIORITY, timeout=None):
+        """Bury the job with given id."""
+        return self._call(timeout, self._job_command, 'bury', job_id, True,
+                priority)
+
+    def touch(self, job_id, timeout=None):
+        """Touch a reserved job, requesting more time to work on it."""
+        return self._call(timeout, self._job_command, 'touch', job_id, False)
+
+    @coroutine
+    def _job_command(self, name, job_id, done, *args):
+        # send the command on the connection that reserved the job, and
+        # forget the connection, when done with the job
+        if done:
+            index = self._owners.pop(job_id, None)
+        else:
+            index = self._owners.get(job_id)
+        if index is None:
+            index = self._pick()
+        result = yield getattr(self._clients[index], name)(job_id, *args)
+        raise Return(result)
+
+    #
+    #  Other commands
+    #
+
+    def peek(self, job_id, timeout=None):
+        """Peek at the job with given id."""
+        return self._call(timeout, self._command, 'peek', None, job_id)
+
+    def peek_ready(self, tube='default', timeout=None):
+        """Peek at the next ready job in the tube."""
+        self._check_tube(tube)
+        return self._call(timeout, self._command, 'peek_ready', tube)
+
+    def peek_delayed(self, tube='default', timeout=None):
+        """Peek at the delayed job with the shortest delay left in the tube.
+        """
+        self._check_tube(tube)
+        return self._call(timeout, self._command, 'peek_delayed', tube)
+
+    def peek_buried(self, tube='default', timeout=None):
+        """Peek at the next buried job in the tube."""
+        self._check_tube(tube)
+        return self._call(timeout, self._command, 'peek_buried', tube)
+
+    def kick(self, bound=1, tube='default', timeout=None):
+        """Kick at most bound jobs into the ready queue of the tube."""
+        self._check_tube(tube)
+        return self._call(timeout, self._command, 'kick', tube, bound)
+
+    def kick_job(self, job_id, timeout=None):
+        """Kick the job with given id into the ready queue."""
+        return self._call(timeout, self._command, 'kick_job', None, job_id)
+
+    def stats_job(self, job_id, timeout=None):
+        """Returns a dict of stats about the job with given id."""
+        return self._call(timeout, self._command, 'stats_job', None, job_id)
+
+    def stats_tube(self, name, timeout=None):
+        """Returns a dict of stats about the tube with given name."""
+        return self._call(timeout, self._command, 'stats_tube', None, name)
+
+    def stats(self, timeout=None):
+        """Returns a dict of stats about the server."""
+        return self._call(timeout, self._command, 'stats', None)
+
+    def list_tubes(self, timeout=None):
+        """Returns a list of the existing tubes."""
+        return self._call(timeout, self._command, 'list_tubes', None)
+
+    def pause_tube(self, name, delay, timeout=None):
+        """Pause the tube with given name for delay seconds."""
+        return self._call(timeout, self._command, 'pause_tube', None, name,
+                delay)
+
+    @coroutine
+    def _command(self, name, tube, *args):
+        # send the command, after a use command for the tube, if given
+        client = self._clients[self._pick()]
+        requests = self._using(client, tube) if tube else []
+        requests.append(getattr(client, name)(*args))
+        results = yield requests
+        raise Return(self._result(results))
@@ -0,0 +1,310 @@
+"""beanstalkt.worker - Job workers for the beanstalkt client
+
+A worker reserves jobs from the tubes it has handlers registered for, and
+runs the handler for each job. Handlers can be run on the IOLoop, or be
+offloaded to an executor (a ThreadPoolExecutor or a ProcessPoolExecutor from
+concurrent.futures), so that CPU-bound handlers do not stall the client's
+communication with beanstalkd.
+
+Jobs whose handler fails can be retried after a growing delay, following a
+retry policy, until they are buried or moved to a dead-letter tube.
+"""
+
+import logging
+import random
+import time
+
+from collections import OrderedDict
+
+from tornado.concurrent import Future
+from tornado.gen import coroutine, maybe_future, Task, Return
+
+from .beanstalkt import (DEFAULT_PRIORITY, DEFAULT_TTR, RECONNECT_TIMEOUT,
+        DeadlineSoon, TimedOut)
+
+
+logger = logging.getLogger('beanstalkt.worker')
+
+MAX_TRACKED = 10000  # Max. number of failed jobs tracked by a worker
+POLL_INTERVAL = 0.01  # Min. time (in seconds) between polling reserves
+
+
+class ReleaseJob(Exception):
+    """Raised by a job handler to release the job back into the ready queue,
+    with an optional new priority and delay (in seconds).
+    """
+    def __init__(self, priority=DEFAULT_PRIORITY, delay=0):
+        Exception.__init__(self, priority, delay)
+        self.priority = priority
+        self.delay = delay
+
+
+class BuryJob(Exception):
+    """Raised by a job handler to bury the job, with an optional new
+    priority.
+    """
+    def __init__(self, priority=DEFAULT_PRIORITY):
+        Exception.__init__(self, priority)
+        self.priority = priority
+
+
+class RetryPolicy(object):
+    """A policy for retrying jobs whose handler failed.
+
+    A failed job is released with a delay of `base_delay` seconds after the
+    first failed attempt, growing by `factor` for each attempt after that, up
+    to `max_delay` seconds. With a jitter between 0 and 1, the delay is
+    reduced by a random fraction of up to `jitter`, spreading out the retries
+    of jobs failing together (a jitter of 1 gives "full jitter"). As
+    beanstalkd delays are whole seconds, the delay is rounded, and is at
+    least 1 second; a `base_delay` of 0 retries a job at once.
+
+    After `max_attempts` failed attempts, the job is moved to the
+    `dead_letter` tube if given (a put into the tube followed by a delete),
+    otherwise the job is buried.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1, factor=2,
+                 max_delay=3600, jitter=0.0, dead_letter=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.dead_letter = dead_letter
+
+    def delay(self, attempts):
+        """The delay in seconds before retrying, after the given number of
+        failed attempts.
+        """
+        delay = min(self.base_delay * self.factor ** (attempts - 1),
+                self.max_delay)
+        if self.jitter:
+            delay *= 1 - self.jitter * random.random()
+        if self.base_delay <= 0:
+            return 0
+        return max(int(round(delay)), 1)
+
+
+class Worker(object):
+    """Reserve jobs from the registered tubes and run their handlers.
+
+    A handler is called with the job body. When the handler returns, the job
+    is deleted. The handler may raise ReleaseJob or BuryJob to have the job
+    released or buried instead. Any other exception is logged and the job is
+    buried, or retried following the retry policy of the handler.
+
+    Handlers registered with an executor are run in the executor. The job
+    body is passed to the executor as bytes, and the outcome is mapped to
+    delete/release/bury on the IOLoop thread. Handlers for a
+    ProcessPoolExecutor must be picklable, i.e. module level functions.
+    Handlers registered without an executor are run on the IOLoop and may be
+    coroutines. If the client has a buffer pool, these handlers get the body
+    as a memoryview, which is valid until the handler returns.
+
+    At most `max_jobs` jobs are processed at a time. When no jobs are being
+    processed, the worker reserves with a timeout of `reserve_timeout`
+    seconds. While jobs are being processed, the commands for these jobs
+    (delete, release, bury and touch) must not wait behind a pending reserve
+    on the connection, so the worker polls with a reserve timing out at once,
+    backing off from POLL_INTERVAL up to `reserve_timeout` seconds between
+    the polls while no job is ready. When beanstalkd reports that the
+    deadline of a reserved job is soon, all jobs being processed are touched.
+
+    The worker should have a client of its own, as it changes the client's
+    watch list.
+    """
+
+    def __init__(self, client, max_jobs=1, reserve_timeout=1):
+        self.client = client
+        self.io_loop = client.io_loop
+        self.max_jobs = max_jobs
+        self.reserve_timeout = reserve_timeout
+        self._handlers = {}
+        self._jobs = {}  # jobs being processed, job id -> tube
+        self._failures = OrderedDict()  # job id -> (failures, priority)
+        self._running = False
+        self._reserving = False
+        self._slot = None
+        self._stopped = None
+        self._interval = POLL_INTERVAL
+
+    def register(self, tube, handler, executor=None, retry=None):
+        """Register a handler for jobs in the tube with given name,
+        optionally to be run in the given executor, and with a RetryPolicy
+        for the jobs failing.
+        """
+        self._handlers[tube] = (handler, executor, retry)
+
+    @coroutine
+    def start(self):
+        """Watch the registered tubes and process jobs, until the worker is
+        stopped.
+        """
+        for tube in self._handlers:
+            yield self.client.watch(tube)
+        if 'default' not in self._handlers:
+            yield self.client.ignore('default')
+        self._running = self._reserving = True
+        try:
+            yield self._reserve_jobs()
+        finally:
+            self._reserving = False
+            self._check_stopped()
+
+    @coroutine
+    def _reserve_jobs(self):
+        while self._running:
+            if len(self._jobs) >= self.max_jobs:
+                # wait for a job to finish
+                self._slot = Future()
+                yield self._slot
+                continue
+            polling = bool(self._jobs)
+            if polling:
+                job = yield self.client.reserve(0)
+            else:
+                job = yield self.client.reserve(self.reserve_timeout)
+            if isinstance(job, TimedOut):
+                if polling:
+                    yield self._backoff()
+                continue
+            elif isinstance(job, DeadlineSoon):
+                yield [self.client.touch(job_id) for job_id in self._jobs]
+                continue
+            elif isinstance(job, Exception):
+                logger.error('Reserve failed: %s', job)
+                yield Task(self.io_loop.add_timeout,
+                        time.time() + RECONNECT_TIMEOUT)
+                continue
+            self._interval = POLL_INTERVAL
+            tube = yield self._tube_of(job)
+            self._jobs[job.id] = tube
+            self._process(job, tube)
+
+    def stop(self):
+        """Stop reserving jobs. Jobs being processed are finished. Returns a
+        future, which is resolved when the jobs have been finished.
+        """
+        self._running = False
+        self._stopped = Future()
+        self._free_slot()
+        self._check_stopped()
+        return self._stopped
+
+    def _check_stopped(self):
+        if (self._stopped and not self._stopped.done() and
+                not self._reserving and not self._jobs):
+            self._stopped.set_result(None)
+
+    def _free_slot(self):
+        if self._slot and not self._slot.done():
+            self._slot.set_result(None)
+
+    @coroutine
+    def _backoff(self):
+        # wait before polling again, or until a job has finished
+        timeout = self.io_loop.add_timeout(time.time() + self._interval,
+                self._free_slot)
+        self._interval = min(self._interval * 2,
+                max(self.reserve_timeout, POLL_INTERVAL))
+        self._slot = Future()
+        yield self._slot
+        self.io_loop.remove_timeout(timeout)
+
+    @coroutine
+    def _tube_of(self, job):
+        # only look up the tube, when more than one tube is being watched
+        if len(self._handlers) == 1:
+            raise Return(next(iter(self._handlers)))
+        stats = yield self.client.stats_job(job.id)
+        if isinstance(stats, Exception):
+            raise Return(None)
+        self._track(job.id, stats['releases'], stats['pri'], stats['ttr'])
+        raise Return(stats['tube'])
+
+    @coroutine
+    def _process(self, job, tube):
+        retry = None
+        released = False  # for a retry
+        try:
+            if tube not in self._handlers:
+                raise BuryJob()
+            handler, executor, retry = self._handlers[tube]
+            if executor is None:
+                yield maybe_future(handler(job.body))
+            else:
+                # a body read into a pooled buffer is copied, to be
+                # picklable, and as the buffer is reused after the job
+                body = job.body
+                if isinstance(body, memoryview):
+                    body = body.tobytes()
+                yield executor.submit(handler, body)
+        except ReleaseJob as e:
+            yield self.client.release(job.id, e.priority, e.delay)
+        except BuryJob as e:
+            yield self.client.bury(job.id, e.priority)
+        except Exception:
+            logger.exception('Job %s from tube %s failed', job.id, tube)
+            if retry:
+                released = yield self._retry(job, retry)
+            else:
+                yield self.client.bury(job.id)
+        else:
+            yield self.client.delete(job.id)
+        finally:
+            del self._jobs[job.id]
+            if not released:
+                self._failures.pop(job.id, None)
+            self._free_slot()
+            self._check_stopped()
+
+    def _track(self, job_id, failures, priority, ttr):
+        # remember the failed attempts (and priority and ttr) of a job, so
+        # that they need not be looked up, when the job is retried by this
+        # worker
+        self._failures.pop(job_id, None)
+        self._failures[job_id] = (failures, priority, ttr)
+        while len(self._failures) > MAX_TRACKED:
+            self._failures.popitem(last=False)
+
+    @coroutine
+    def _retry(self, job, retry):
+        if job.id in self._failures:
+            failures, priority, ttr = self._failures[job.id]
+        else:
+            # the job has been released once for each failed attempt
+            stats = yield self.client.stats_job(job.id)
+            if isinstance(stats, Exception):
+                failures, priority, ttr = 0, DEFAULT_PRIORITY, DEFAULT_TTR
+            else:
+                failures, priority, ttr = (stats['releases'], stats['pri'],
+                        stats['ttr'])
+        failures += 1
+        if failures < retry.max_attempts:
+            resp = yield self.client.release(job.id, priority,
+                    retry.delay(failures))
+            if isinstance(resp, Exception):
+                raise Return(False)
+            self._track(job.id, failures, priority, ttr)
+            raise Return(True)
+        logger.warning('Job %s failed %d times, giving up', job.id, failures)
+        if retry.dead_letter:
+            client = self.client
+            body = job.body
+            if isinstance(body, memoryview):
+                # a pooled body, whose buffer is reused after the delete
+                body = body.tobytes()
+            previous = client._using
+            # the job keeps its priority, time to run and trace id
+            results = yield [client.use(retry.dead_letter),
+                    client.put(body, priority, ttr=ttr,
+                        trace_id=job.get('trace_id')),
+                    client.use(previous)]
+            if not isinstance(results[1], Exception):
+                yield client.delete(job.id)
+                raise Return(False)
+            logger.error('Moving job %s to the dead-letter tube failed: %s',
+                    job.id, results[1])
+        yield self.client.bury(job.id, priority)
+        raise Return(False)